@@ -0,0 +1,267 @@
+"""
+Offline benchmark for the parsing pipeline of reader.py
+
+Times page parsing and day extraction of every parser backend on a corpus
+of recorded and synthetic UNTIS week pages and reports throughput, latency
+percentiles and the peak memory of a parse.
+
+    python bench.py                          # run and print the report
+    python bench.py --save-baseline FILE     # store the results
+    python bench.py --baseline FILE          # fail if slower than stored
+    python bench.py --record 10 11           # save weeks from the live server
+"""
+import argparse
+import asyncio
+import glob
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import reader
+
+# name: (page -> tree, tree -> [DayInfo])
+BACKENDS = {
+    "bs4": (reader.parse_page, reader.find),
+    "lxml": (reader.parse_page_lxml, reader.find_lxml),
+    "lazy": (reader.parse_week_lazy, list),
+}
+
+RECORDED_DIR = "bench_pages"
+
+GRADES = ["5a", "5b", "6c", "7a", "8b", "9d", "10a", "Q12", "Q34"]
+TEACHERS = ["Mu", "Ab", "Ke", "Zi", "Sc", "Wa", "Ho", "Fr"]
+LESSONS = ["m1", "d3", "e2", "pw76", "ch1", "bio2", "sp4", "ku1"]
+ROOMS = ["A1", "A2", "B1", "D107", "D108", "Sp1", "K12"]
+TEXTS = ["", "", "", "Aufgaben im Moodle", "fällt aus", "Raumtausch"]
+
+# mirrors the markup UNTIS generates: every cell wrapped in font tags
+CELL = '<td class="list" align="center"><font size="3">{}</font></td>'
+
+
+def make_week_page(rows=20, info_rows=3, seed=0) -> str:
+    """
+    generates a week page with rows substitutions and info_rows messages
+    per day
+    """
+    rand = random.Random(seed)
+    parts = ['<html><head><meta http-equiv="Content-Type" '
+             'content="text/html; charset=iso-8859-1"></head><body>'
+             '<center><div id="vertretung">']
+    for day in range(1, 6):
+        parts.append('<a name="{}">&nbsp;</a><br><b>{}.12. Montag</b>'
+                     .format(day, day))
+        if info_rows:
+            parts.append('<table class="info"><tr class="info">'
+                         '<th class="info" colspan="2">Nachrichten zum Tag'
+                         '</th></tr>')
+            for i in range(info_rows):
+                parts.append('<tr class="info"><td class="info" colspan="2">'
+                             'Nachricht {} f&uuml;r alle Klassen</td></tr>'
+                             .format(i))
+            parts.append('</table>')
+        parts.append('<table class="subst"><tr class="list">' + "".join(
+            '<th class="list">{}</th>'.format(h) for h in
+            ["Stunde", "Klasse(n)", "Vertreter", "Fach", "Raum",
+             "Vertretungs-Text", "(Lehrer)", "(Fach)", "(Raum)"]) + '</tr>')
+        for _ in range(rows):
+            teacher = rand.choice(TEACHERS)
+            lesson = rand.choice(LESSONS)
+            room = rand.choice(ROOMS)
+            cancelled = rand.random() < 0.3
+            cells = [str(rand.randint(1, 10)), rand.choice(GRADES),
+                     "---" if cancelled else rand.choice(TEACHERS),
+                     "---" if cancelled else lesson,
+                     "---" if cancelled else rand.choice(ROOMS),
+                     rand.choice(TEXTS) or "&nbsp;", teacher, lesson, room]
+            parts.append('<tr class="list odd">' +
+                         "".join(CELL.format(c) for c in cells) + '</tr>')
+        parts.append('</table>')
+    parts.append('</div></center></body></html>')
+    return "".join(parts)
+
+
+def load_corpus(directory=RECORDED_DIR) -> dict:
+    """
+    returns {name: page} of the recorded pages in directory and a set of
+    synthetic pages of increasing size
+    """
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.htm"))):
+        with open(path, encoding="utf-8") as f:
+            corpus[os.path.basename(path)] = f.read()
+
+    corpus["synthetic-small"] = make_week_page(rows=5, info_rows=1)
+    corpus["synthetic-medium"] = make_week_page(rows=40, info_rows=3)
+    corpus["synthetic-large"] = make_week_page(rows=300, info_rows=10)
+    return corpus
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _peak_rss():
+    # ru_maxrss would survive the exec of the child and start at the peak of
+    # this process, VmHWM is reset with the new address space
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+
+def _measure_rss(backend, page):
+    parse_page, find = BACKENDS[backend]
+    before = _peak_rss()
+    find(parse_page(page))
+    return _peak_rss() - before
+
+
+def peak_rss_kib(backend, page):
+    """
+    growth of the peak RSS of a fresh process by a single parse, in KiB
+    (Linux only). tracemalloc can't be used since lxml allocates the tree
+    in libxml2, outside of Python
+    """
+    # a forked child would start with the memory of this process
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_measure_rss, (backend, page))
+
+
+def bench_backend(backend, page, repeat):
+    """
+    parses page repeat times and returns the timings of the stages and the
+    peak memory of a single parse
+    """
+    parse_page, find = BACKENDS[backend]
+
+    page_times = []
+    find_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tree = parse_page(page)
+        parsed = time.perf_counter()
+        days = find(tree)
+        found = time.perf_counter()
+        page_times.append(parsed - start)
+        find_times.append(found - parsed)
+
+    totals = [a + b for a, b in zip(page_times, find_times)]
+    rows = sum(len(day.data) for day in days)
+    return {
+        "rows": rows,
+        "parse_page_ms": 1000 * percentile(page_times, 50),
+        "find_ms": 1000 * percentile(find_times, 50),
+        "p50_ms": 1000 * percentile(totals, 50),
+        "p90_ms": 1000 * percentile(totals, 90),
+        "p99_ms": 1000 * percentile(totals, 99),
+        "pages_per_s": len(totals) / sum(totals),
+        "rows_per_s": rows * len(totals) / sum(totals),
+        "peak_kib": peak_rss_kib(backend, page),
+    }
+
+
+def run(corpus, backends, repeat) -> dict:
+    """
+    returns {"page/backend": results} for all pages and backends
+    """
+    results = {}
+    for name, page in corpus.items():
+        for backend in backends:
+            results["{}/{}".format(name, backend)] = bench_backend(
+                backend, page, repeat)
+    return results
+
+
+def report(results):
+    header = "{:<32} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9}"
+    print(header.format("page/backend", "rows", "page ms", "find ms",
+                        "p50 ms", "p90 ms", "p99 ms", "rows/s", "peak KiB"))
+    row = ("{:<32} {rows:>6} {parse_page_ms:>8.2f} {find_ms:>8.2f} "
+           "{p50_ms:>8.2f} {p90_ms:>8.2f} {p99_ms:>8.2f} {rows_per_s:>9.0f} "
+           "{peak_kib:>9.0f}")
+    for name, res in sorted(results.items()):
+        print(row.format(name, **res))
+
+
+def compare(results, baseline, tolerance) -> list:
+    """
+    returns a message for every result whose median is more than tolerance
+    slower than in the baseline
+    """
+    regressions = []
+    for name, res in sorted(results.items()):
+        if name not in baseline:
+            continue
+        limit = baseline[name]["p50_ms"] * (1 + tolerance)
+        if res["p50_ms"] > limit:
+            regressions.append("{}: {:.2f}ms, baseline {:.2f}ms".format(
+                name, res["p50_ms"], baseline[name]["p50_ms"]))
+    return regressions
+
+
+def record(weeks):
+    """
+    downloads weeks from the server in ../keyfile into RECORDED_DIR
+    """
+    config = {}
+    with open("../keyfile", "r") as f:
+        for line in f:
+            if not line.startswith("#") or line.strip() == "":
+                key, value = line.split("=")
+                config[key.strip()] = value.strip()
+
+    os.makedirs(RECORDED_DIR, exist_ok=True)
+    loop = asyncio.get_event_loop()
+    vplan = reader.Reader(config["url"], (config["user"], config["pass"]))
+    try:
+        for weeknum in weeks:
+            page = loop.run_until_complete(
+                vplan._download(vplan.url.format(weeknum=weeknum)))
+            path = os.path.join(RECORDED_DIR, "week{:02}.htm".format(weeknum))
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(page)
+            print("recorded", path)
+    finally:
+        vplan.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--backend", action="append", choices=list(BACKENDS),
+                        help="backend to run, may be repeated (default: all)")
+    parser.add_argument("--baseline", help="JSON file to compare against")
+    parser.add_argument("--save-baseline", help="JSON file to store results in")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline")
+    parser.add_argument("--record", type=int, nargs="+", metavar="WEEK",
+                        help="record weeks from the live server and exit")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record)
+        return 0
+
+    results = run(load_corpus(), args.backend or sorted(BACKENDS), args.repeat)
+    report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+Sends one message to many chats at once while staying within Telegram's
+rate limits
+"""
+from collections import namedtuple
+import asyncio
+import logging
+
+import telepot
+
+from cache import TTLCache
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class RetryAfterError(telepot.TelegramError):
+    """
+    TelegramError that keeps the retry_after Telegram sends with 429 Too Many
+    Requests, which telepot drops
+    """
+    def __init__(self, description, error_code, retry_after):
+        super().__init__(description, error_code)
+        self.retry_after = retry_after
+
+
+def telegram_error(data):
+    """
+    returns the exception for the Bot API error response data
+    """
+    retry = data.get("parameters", {}).get("retry_after")
+    if retry is not None:
+        return RetryAfterError(data["description"], data["error_code"], retry)
+    return telepot.TelegramError(data["description"], data["error_code"])
+
+
+def retry_after(error):
+    """
+    returns the seconds Telegram asked us to wait, or None if error isn't a
+    429 Too Many Requests
+    """
+    if getattr(error, "error_code", None) != 429:
+        return None
+    return getattr(error, "retry_after", 1)
+
+
+class FanOutResult(namedtuple("FanOutResult", ["sent", "failed", "elapsed"])):
+    """
+    chat ids a message was sent to or failed for, and the seconds it took
+    """
+    @property
+    def throughput(self):
+        total = len(self.sent) + len(self.failed)
+        return total / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        return "sent {} messages, {} failed in {:.1f}s ({:.1f} msg/s)".format(
+            len(self.sent), len(self.failed), self.elapsed, self.throughput)
+
+
+class FanOut:
+    """
+    Sends messages to many chats with bounded concurrency. Every message
+    takes a token from a global bucket and one for its chat, and messages
+    rejected with 429 are retried after the time Telegram asks for
+    """
+    def __init__(self, send, concurrency=20, rate=30, per_chat_rate=1,
+                 retries=3, loop=None):
+        """
+        send: coroutine function (chat_id, message), e.g. Bot.sendMessage
+        concurrency: maximum number of messages in flight
+        rate: messages per second over all chats
+        per_chat_rate: messages per second to a single chat
+        retries: how often a message is retried after a 429
+        """
+        self.send = send
+        self.concurrency = concurrency
+        self.per_chat_rate = per_chat_rate
+        self.retries = retries
+        self.loop = loop or asyncio.get_event_loop()
+        self.bucket = TokenBucket(rate, loop=self.loop)
+        # only chats that got a message recently need their bucket
+        self._chat_buckets = TTLCache(60, maxsize=10000)
+
+    @asyncio.coroutine
+    def run(self, chat_ids, message) -> FanOutResult:
+        """
+        sends message to all chat_ids and waits until all are done
+        """
+        start = self.loop.time()
+        sent = []
+        failed = []
+        chats = iter(chat_ids)
+
+        @asyncio.coroutine
+        def worker():
+            for chat_id in chats:
+                if (yield from self.send_one(chat_id, message)):
+                    sent.append(chat_id)
+                else:
+                    failed.append(chat_id)
+
+        yield from asyncio.gather(
+            *[worker() for _ in range(self.concurrency)], loop=self.loop)
+
+        result = FanOutResult(sent, failed, self.loop.time() - start)
+        logger.info(str(result))
+        return result
+
+    @asyncio.coroutine
+    def send_one(self, chat_id, message) -> bool:
+        """
+        sends a single message, returns whether it was delivered
+        """
+        chat_bucket = self._chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = TokenBucket(self.per_chat_rate, 1, loop=self.loop)
+            self._chat_buckets[chat_id] = chat_bucket
+
+        for attempt in range(self.retries + 1):
+            yield from chat_bucket.acquire()
+            yield from self.bucket.acquire()
+            try:
+                yield from self.send(chat_id, message)
+                return True
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None or attempt == self.retries:
+                    logger.error("could not send message to %s: %s", chat_id, e)
+                    return False
+                logger.warning("rate limited sending to %s, waiting %ss",
+                               chat_id, wait)
+                yield from asyncio.sleep(wait, loop=self.loop)
@@ -0,0 +1,135 @@
+"""
+Bounded in-memory cache with expiry, used for downloaded and parsed
+substitutions
+"""
+from collections import OrderedDict
+import sys
+import time
+
+
+class TTLCache:
+    """
+    Least recently used cache where every entry expires ttl seconds after it
+    was stored.
+
+    Entries are checked for expiry when they are accessed, so a lookup never
+    has to scan the whole cache. Expired entries that are not accessed
+    anymore drift to the LRU end and are evicted from there.
+    """
+    def __init__(self, ttl, maxsize=128, maxbytes=None, sizeof=sys.getsizeof,
+                 clock=time.monotonic):
+        """
+        ttl: seconds an entry is valid
+        maxsize: maximum number of entries
+        maxbytes: maximum sum of sizeof() of all values, None for no limit
+        sizeof: function returning the size of a value
+        clock: function returning the current time in seconds
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.clock = clock
+
+        self._data = OrderedDict() # key: (value, expiry time, size)
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[1] > self.clock()
+
+    def __getitem__(self, key):
+        try:
+            value, expires, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        if expires <= self.clock():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            raise KeyError(key)
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        """
+        stores value for ttl seconds instead of the default ttl of the cache
+        """
+        if key in self._data:
+            self._remove(key)
+
+        size = self.sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+
+        if ttl is None:
+            ttl = self.ttl
+        self._data[key] = (value, self.clock() + ttl, size)
+        self.nbytes += size
+        self._shrink()
+
+    def __delitem__(self, key):
+        self._remove(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self.nbytes -= size
+
+    def _shrink(self):
+        """
+        evicts least recently used entries until the cache is within bounds
+        """
+        while (len(self._data) > self.maxsize or
+               (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            key, (_, expires, size) = self._data.popitem(last=False)
+            self.nbytes -= size
+            if expires <= self.clock():
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        returns the hit, miss and eviction counters and the current size
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": len(self._data),
+            "bytes": self.nbytes,
+        }
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        return ("{entries} entries, {bytes} bytes\n"
+                "{hits} hits, {misses} misses ({ratio:.0%} hit rate)\n"
+                "{evictions} evicted, {expirations} expired").format(
+                    ratio=ratio, **self.stats())
@@ -4,11 +4,68 @@ Database Module. Used to manage users and their settings
 
 import sqlite3
 import datetime
+import functools
 import hashlib
 import logging
+import pickle
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
 
 logger = logging.getLogger(__name__)
 
+
+def connect(path):
+    """
+    opens the database at path, tuned for many small writes from one process
+    """
+    connection = sqlite3.connect(path)
+    # WAL lets commits append to a log instead of rewriting pages, and with
+    # synchronous=NORMAL only checkpoints wait for fsync
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA cache_size=-8000") # in KiB
+    return connection
+
+
+def _migrate_users_created(cur):
+    """
+    adds the first-seen time of users and makes the broadcast flag default
+    to false, so new users can be inserted with INSERT OR IGNORE
+    """
+    cur.execute("ALTER TABLE users ADD COLUMN created INT")
+    cur.execute("UPDATE users SET recieve_broadcast=0 "
+                "WHERE recieve_broadcast IS NULL")
+
+def _migrate_users_plan(cur):
+    """
+    adds the plan a user gets substitutions from, NULL for the default plan
+    """
+    cur.execute("ALTER TABLE users ADD COLUMN plan TEXT")
+
+# MIGRATIONS[i] upgrades the schema from version i to i + 1
+MIGRATIONS = [
+    _migrate_users_created,
+    _migrate_users_plan,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(connection):
+    """
+    runs all migrations newer than the schema version of the database
+    """
+    cur = connection.cursor()
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    for i in range(version, SCHEMA_VERSION):
+        logger.info("migrating database to version %s", i + 1)
+        MIGRATIONS[i](cur)
+        cur.execute("PRAGMA user_version={:d}".format(i + 1))
+        connection.commit()
+
 class SubstManager:
     def __init__(self, connection):
         """
@@ -20,24 +77,89 @@ class SubstManager:
                          "id INTEGER PRIMARY KEY,"
                          "hash TEXT NOT NULL,"
                          "time INT NOT NULL);")
+        # older databases may contain duplicates, which the unique index
+        # doesn't allow
+        self.cur.execute("DELETE FROM messages WHERE id NOT IN "
+                         "(SELECT MIN(id) FROM messages GROUP BY hash)")
+        self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_hash "
+                         "ON messages(hash)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS messages_time "
+                         "ON messages(time)")
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS incoming("
+                         "hash TEXT PRIMARY KEY,"
+                         "time INT NOT NULL);")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS state("
+                         "key TEXT PRIMARY KEY,"
+                         "value TEXT);")
+        # databases from before the marker existed were polled if they have
+        # any substitutions, which were all from the default plan
+        self.cur.execute("INSERT OR IGNORE INTO state(key, value) "
+                         "SELECT 'substs_initialized', '1' "
+                         "WHERE EXISTS (SELECT 1 FROM messages)")
+        self.conn.commit()
 
     @staticmethod
-    def hash_subst(subst, date) -> str:
+    def hash_subst(subst, date, plan=None) -> str:
+        """
+        plan: the plan subst is from, None for the default plan. The same
+        substitution on two plans hashes differently
+        """
         d_fmt = date.strftime("%Y%j") # %Y = year ("2016"), %j = day ("129")
         prehash = "".join(subst) + d_fmt
+        if plan is not None:
+            prehash = plan + ":" + prehash
         return hashlib.md5(prehash.encode("utf-8")).digest()
 
-    def check_new_and_register(self, subst, date):
-        subst_hash = SubstManager.hash_subst(subst, date)
-        self.cur.execute("SELECT id FROM messages WHERE hash=?", (subst_hash, ))
-        res = self.cur.fetchone()
+    def check_new_and_register(self, subst, date, plan=None):
+        return bool(self.register_new([(subst, date)], plan))
 
-        if res is None:
-            self.cur.execute("INSERT INTO messages(hash,time) VALUES (?, ?)",
-                            (subst_hash, date.strftime("%s")))
-            return True
-        else:
-            return False
+    def register_new(self, items, plan=None) -> list:
+        """
+        registers many (subst, date) pairs of plan at once and returns the
+        ones that weren't registered before, in their original order
+        """
+        hashed = [(SubstManager.hash_subst(subst, date, plan), (subst, date))
+                  for subst, date in items]
+
+        self.cur.execute("DELETE FROM incoming")
+        self.cur.executemany("INSERT OR IGNORE INTO incoming(hash, time) "
+                             "VALUES (?, ?)",
+                             ((subst_hash, date.strftime("%s"))
+                              for subst_hash, (_, date) in hashed))
+        self.cur.execute("SELECT hash FROM incoming WHERE hash NOT IN "
+                         "(SELECT hash FROM messages)")
+        new_hashes = {i[0] for i in self.cur.fetchall()}
+        self.cur.execute("INSERT OR IGNORE INTO messages(hash, time) "
+                         "SELECT hash, time FROM incoming")
+
+        res = []
+        for subst_hash, item in hashed:
+            if subst_hash in new_hashes:
+                new_hashes.discard(subst_hash)
+                res.append(item)
+        return res
+
+    @staticmethod
+    def _initialized_key(plan):
+        if plan is None:
+            return "substs_initialized"
+        return "substs_initialized:" + plan
+
+    def is_initialized(self, plan=None) -> bool:
+        """
+        whether substitutions of plan were registered before. Unlike
+        checking for an empty table this stays true after everything has
+        been pruned
+        """
+        self.cur.execute("SELECT 1 FROM state WHERE key=?",
+                         (SubstManager._initialized_key(plan),))
+        return self.cur.fetchone() is not None
+
+    def mark_initialized(self, plan=None):
+        self.cur.execute("INSERT OR IGNORE INTO state(key, value) "
+                         "VALUES (?, '1')",
+                         (SubstManager._initialized_key(plan),))
+        self.conn.commit()
 
     def prune_older_than(self, date):
         """
@@ -46,49 +168,615 @@ class SubstManager:
         self.cur.execute("DELETE FROM messages WHERE time < ?",
                          (date.strftime("%s"),)) # %s: UNIX epoch
 
-class User:
-    pass
+class BroadcastManager:
+    """
+    Stores broadcasts as jobs with a delivery state for every recipient, so
+    a broadcast interrupted by a restart can be resumed without sending
+    anything twice
+    """
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
 
-class Subject:
-    @classmethod
-    def new_subject(sub_id: str, human_name: str=None):
-        pass
+    def __init__(self, connection):
+        """
+        connection: SQLITE database connection
+        """
+        self.conn = connection
+        self.cur = self.conn.cursor()
+        self.cur.execute("CREATE TABLE IF NOT EXISTS broadcast_jobs("
+                         "id INTEGER PRIMARY KEY,"
+                         "message TEXT NOT NULL,"
+                         "created INT NOT NULL,"
+                         "done BOOLEAN NOT NULL DEFAULT 0);")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS broadcast_recipients("
+                         "job_id INTEGER NOT NULL,"
+                         "chat_id INTEGER NOT NULL,"
+                         "state INTEGER NOT NULL DEFAULT 0,"
+                         "PRIMARY KEY (job_id, chat_id));")
+        self.conn.commit()
+
+    def create_job(self, message, chat_ids) -> int:
+        """
+        creates a job sending message to chat_ids, returns the job id
+        """
+        job_id = self._insert_job(message)
+        self.cur.executemany("INSERT OR IGNORE INTO broadcast_recipients"
+                             "(job_id, chat_id) VALUES (?, ?)",
+                             ((job_id, chat_id) for chat_id in chat_ids))
+        self.conn.commit()
+        logger.info("created broadcast job %s", job_id)
+        return job_id
+
+    def create_job_for_all_users(self, message) -> int:
+        """
+        creates a job sending message to every user, without loading the
+        user list into memory
+        """
+        job_id = self._insert_job(message)
+        self.cur.execute("INSERT OR IGNORE INTO broadcast_recipients"
+                         "(job_id, chat_id) SELECT ?, id FROM users",
+                         (job_id,))
+        self.conn.commit()
+        logger.info("created broadcast job %s for all users", job_id)
+        return job_id
+
+    def _insert_job(self, message):
+        self.cur.execute("INSERT INTO broadcast_jobs(message, created) "
+                         "VALUES (?, ?)",
+                         (message, datetime.datetime.now().strftime("%s")))
+        return self.cur.lastrowid
+
+    def unfinished_jobs(self):
+        """
+        returns (id, message) of all jobs that are not done yet
+        """
+        self.cur.execute("SELECT id, message FROM broadcast_jobs "
+                         "WHERE done=0 ORDER BY id")
+        return self.cur.fetchall()
+
+    def expire_jobs(self, created_before) -> list:
+        """
+        gives up the unfinished jobs created before the UNIX time
+        created_before: their pending recipients are marked FAILED and the
+        jobs finished. Returns (id, message) of the expired jobs
+        """
+        self.cur.execute("SELECT id, message FROM broadcast_jobs "
+                         "WHERE done=0 AND created < ? ORDER BY id",
+                         (int(created_before),))
+        jobs = self.cur.fetchall()
+        for job_id, _ in jobs:
+            self.cur.execute("UPDATE broadcast_recipients SET state=? "
+                             "WHERE job_id=? AND state=?",
+                             (self.FAILED, job_id, self.PENDING))
+            self.cur.execute("UPDATE broadcast_jobs SET done=1 WHERE id=?",
+                             (job_id,))
+        self.conn.commit()
+        return jobs
+
+    def pending_recipients(self, job_id, limit=-1):
+        """
+        returns up to limit chat ids that haven't been sent the job yet
+        """
+        self.cur.execute("SELECT chat_id FROM broadcast_recipients "
+                         "WHERE job_id=? AND state=? LIMIT ?",
+                         (job_id, self.PENDING, limit))
+        return [i[0] for i in self.cur.fetchall()]
+
+    def set_state(self, job_id, chat_ids, state):
+        """
+        sets the delivery state of many recipients in one transaction
+        """
+        self.cur.executemany("UPDATE broadcast_recipients SET state=? "
+                             "WHERE job_id=? AND chat_id=?",
+                             ((state, job_id, chat_id) for chat_id in chat_ids))
+        self.conn.commit()
+
+    def finish_job(self, job_id):
+        self.cur.execute("UPDATE broadcast_jobs SET done=1 WHERE id=?",
+                         (job_id,))
+        self.conn.commit()
+
+    def job_counts(self, job_id) -> dict:
+        """
+        returns how many recipients of a job are in each state
+        """
+        self.cur.execute("SELECT state, COUNT(*) FROM broadcast_recipients "
+                         "WHERE job_id=? GROUP BY state", (job_id,))
+        counts = {self.PENDING: 0, self.SENT: 0, self.FAILED: 0}
+        counts.update(self.cur.fetchall())
+        return counts
+
+class User:
     pass
 
 class UserManager:
-    def __init__(self, connection):
+    def __init__(self, connection, batch_size=20, max_delay=5):
         """
         connection: SQLITE database connection
+        batch_size: number of new users that are written at once
+        max_delay: seconds after which new users are written regardless
         """
         self.conn = connection
         self.cur = self.conn.cursor()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
         self.cur.execute("CREATE TABLE IF NOT EXISTS "
         "users(id INTEGER PRIMARY KEY, recieve_broadcast BOOLEAN);")
+        # kind is one of subscriptions.KINDS
+        self.cur.execute("CREATE TABLE IF NOT EXISTS subscriptions("
+                         "user_id INTEGER NOT NULL,"
+                         "kind TEXT NOT NULL,"
+                         "value TEXT NOT NULL,"
+                         "PRIMARY KEY (user_id, kind, value));")
         self.conn.commit()
+        migrate(self.conn)
+
+        # every known user is kept in memory, so checking for new users on
+        # every message doesn't need a query
+        self.cur.execute("SELECT id FROM users")
+        self.known = {i[0] for i in self.cur.fetchall()}
+        self.cur.execute("SELECT id, plan FROM users WHERE plan IS NOT NULL")
+        self.plans = dict(self.cur.fetchall()) # users not on the default plan
+        self.pending = [] # (chat_id, created) not written yet
+        self._pending_since = 0
 
     def is_user(self, chat_id):
-        self.cur.execute("SELECT * FROM users WHERE id=?;", (chat_id,))
-        return self.cur.fetchone() is not None
+        return chat_id in self.known
+
+    def ensure_user(self, chat_id) -> bool:
+        """
+        registers chat_id if it is new and returns whether it was. New users
+        are written in batches, see flush
+        """
+        if chat_id in self.known:
+            return False
+
+        logger.info("created new user {}".format(chat_id))
+        now = time.time()
+        if not self.pending:
+            self._pending_since = now
+        self.known.add(chat_id)
+        self.pending.append((chat_id, int(now)))
+
+        if (len(self.pending) >= self.batch_size or
+                now - self._pending_since >= self.max_delay):
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        writes all pending new users in one transaction
+        """
+        if not self.pending:
+            return
+        self.cur.executemany("INSERT OR IGNORE INTO users"
+                             "(id, recieve_broadcast, created) VALUES (?, 0, ?)",
+                             self.pending)
+        self.conn.commit()
+        self.pending = []
 
     def get_broadcasters(self):
+        self.flush()
         self.cur.execute("SELECT id FROM users WHERE recieve_broadcast=1")
         return [i[0] for i in self.cur.fetchall()]
 
     def get_all_users(self):
+        self.flush()
         self.cur.execute("SELECT id FROM users")
         return [i[0] for i in self.cur.fetchall()]
 
     def set_broadcast(self, chat_id, b):
+        self.flush()
         self.cur.execute("UPDATE users SET recieve_broadcast=? WHERE id=?",
                 (b, chat_id))
         self.conn.commit()
 
     def create_user(self, chat_id):
-        logger.info("created new user {}".format(chat_id))
-        self.cur.execute("INSERT INTO users VALUES (?, ?)", (chat_id, False))
+        self.ensure_user(chat_id)
+        self.flush()
+
+    def subscribe(self, chat_id, kind, value):
+        self.cur.execute("INSERT OR IGNORE INTO subscriptions VALUES (?, ?, ?)",
+                (chat_id, kind, value))
+        self.conn.commit()
+
+    def unsubscribe(self, chat_id, kind, value):
+        self.cur.execute("DELETE FROM subscriptions "
+                         "WHERE user_id=? AND kind=? AND value=?",
+                (chat_id, kind, value))
+        self.conn.commit()
+
+    def get_subscriptions(self, chat_id) -> frozenset:
+        """
+        returns the (kind, value) pairs a user is subscribed to
+        """
+        self.cur.execute("SELECT kind, value FROM subscriptions "
+                         "WHERE user_id=?", (chat_id,))
+        return frozenset(self.cur.fetchall())
+
+    def get_plan(self, chat_id):
+        """
+        returns the name of the plan of a user, None for the default plan
+        """
+        return self.plans.get(chat_id)
+
+    def get_plans(self) -> dict:
+        """
+        returns {chat_id: plan} of all users not on the default plan
+        """
+        return dict(self.plans)
+
+    def set_plan(self, chat_id, plan):
+        self.flush()
+        self.cur.execute("UPDATE users SET plan=? WHERE id=?", (plan, chat_id))
+        self.conn.commit()
+        if plan is None:
+            self.plans.pop(chat_id, None)
+        else:
+            self.plans[chat_id] = plan
+
+    def get_broadcast_page(self, after=None, limit=1000) -> list:
+        """
+        returns [(chat_id, subscriptions)] of up to limit broadcast receivers
+        with an id greater than after, ordered by id. after=None starts with
+        the first receiver
+        """
+        self.flush()
+        if after is None:
+            page = ("SELECT id FROM users WHERE recieve_broadcast=1 "
+                    "ORDER BY id LIMIT ?", (limit,))
+        else:
+            page = ("SELECT id FROM users WHERE recieve_broadcast=1 "
+                    "AND id > ? ORDER BY id LIMIT ?", (after, limit))
+        self.cur.execute("SELECT page.id, kind, value FROM (" + page[0] + ") "
+                         "AS page LEFT JOIN subscriptions ON page.id=user_id "
+                         "ORDER BY page.id", page[1])
+        res = []
+        for chat_id, kind, value in self.cur.fetchall():
+            if not res or res[-1][0] != chat_id:
+                res.append((chat_id, set()))
+            if kind is not None:
+                res[-1][1].add((kind, value))
+        return [(chat_id, frozenset(subs)) for chat_id, subs in res]
+
+
+class AsyncManager:
+    """
+    Wraps a manager living on an AsyncDatabase thread, turning each of its
+    methods into a coroutine that runs on that thread
+    """
+    def __init__(self, database, manager):
+        self._database = database
+        self._manager = manager
+
+    def __getattr__(self, name):
+        method = getattr(self._manager, name)
+
+        @asyncio.coroutine
+        def call(*args, **kwargs):
+            return (yield from self._database.run(
+                functools.partial(method, *args, **kwargs)))
+        call.__name__ = name
+        return call
+
+
+class AsyncUserManager(AsyncManager):
+    """
+    AsyncManager of a UserManager that writes a pending new user at most
+    max_delay seconds after it was seen, even if no other user follows
+    """
+    def __init__(self, database, manager):
+        super().__init__(database, manager)
+        self._flush_timer = None
+
+    @asyncio.coroutine
+    def ensure_user(self, chat_id):
+        new = yield from self._database.run(self._manager.ensure_user, chat_id)
+        if new and self._manager.pending and self._flush_timer is None:
+            self._flush_timer = self._database.loop.call_later(
+                self._manager.max_delay, self._flush_later)
+        return new
+
+    def _flush_later(self):
+        self._flush_timer = None
+        asyncio.ensure_future(self._database.run(self._manager.flush),
+                              loop=self._database.loop)
+
+    def cancel(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+
+class SnapshotManager:
+    """
+    Keeps the last parsed snapshot of every UNTIS page, compressed, so a
+    restarted bot can answer from it instead of downloading everything again
+    """
+    def __init__(self, connection):
+        """
+        connection: SQLITE database connection
+        """
+        self.conn = connection
+        self.cur = self.conn.cursor()
+        self.cur.execute("CREATE TABLE IF NOT EXISTS snapshots("
+                         "url TEXT PRIMARY KEY,"
+                         "fetched REAL NOT NULL,"
+                         "data BLOB NOT NULL,"
+                         "etag TEXT,"
+                         "last_modified TEXT);")
+        # tables from before the validators had their own columns
+        columns = [row[1] for row in
+                   self.cur.execute("PRAGMA table_info(snapshots)")]
+        if "etag" not in columns:
+            self.cur.execute("ALTER TABLE snapshots ADD COLUMN etag TEXT")
+            self.cur.execute("ALTER TABLE snapshots "
+                             "ADD COLUMN last_modified TEXT")
+        self.conn.commit()
+
+    def save(self, url, snapshot):
+        """
+        stores a reader.Snapshot, replacing the one stored for url
+        """
+        data = zlib.compress(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+        self.cur.execute("INSERT OR REPLACE INTO snapshots"
+                         "(url, fetched, data, etag, last_modified) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (url, snapshot.fetched, sqlite3.Binary(data),
+                          snapshot.etag, snapshot.last_modified))
         self.conn.commit()
 
-    def get_subjects(self, chat_id):
-        raise NotImplementedError
-        self.cur.execute("SELECT * FROM users_lessons where id=?",
-                (chat_id,))
+    def touch(self, url, snapshot):
+        """
+        updates the fetch time and validators stored for url from snapshot,
+        for a page that didn't change. The week itself isn't written again
+        """
+        self.cur.execute("UPDATE snapshots SET fetched=?, etag=?, "
+                         "last_modified=? WHERE url=?",
+                         (snapshot.fetched, snapshot.etag,
+                          snapshot.last_modified, url))
+        self.conn.commit()
+
+    def load(self, url):
+        """
+        returns the reader.Snapshot stored for url, or None
+        """
+        self.cur.execute("SELECT data, fetched, etag, last_modified "
+                         "FROM snapshots WHERE url=?", (url,))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        try:
+            snapshot = pickle.loads(zlib.decompress(row[0]))
+        except Exception:
+            # stored by an incompatible version of reader.py
+            logger.warning("dropping unreadable snapshot of %s", url)
+            self.cur.execute("DELETE FROM snapshots WHERE url=?", (url,))
+            self.conn.commit()
+            return None
+        if row[1] == snapshot.fetched:
+            return snapshot
+        # touched since the week was stored
+        return snapshot._replace(fetched=row[1], etag=row[2],
+                                 last_modified=row[3])
+
+    def prune_older_than(self, timestamp):
+        """
+        DELETEs the snapshots fetched before the UNIX time timestamp
+        """
+        self.cur.execute("DELETE FROM snapshots WHERE fetched < ?",
+                         (timestamp,))
+
+
+class ArchiveManager:
+    """
+    Archive of every distinct version of the week pages, to answer questions
+    about a whole school year.
+
+    Each version is kept once, compressed, under the hash of its content.
+    The latest rows of every day are also stored as a table of string ids,
+    indexed by day, grade, teacher and room for the aggregate queries
+    """
+    def __init__(self, connection):
+        """
+        connection: SQLITE database connection
+        """
+        self.conn = connection
+        self.cur = self.conn.cursor()
+        self.cur.execute("CREATE TABLE IF NOT EXISTS archive_weeks("
+                         "digest TEXT PRIMARY KEY,"
+                         "week_start TEXT NOT NULL,"
+                         "archived INT NOT NULL,"
+                         "data BLOB NOT NULL);")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS archive_strings("
+                         "id INTEGER PRIMARY KEY,"
+                         "value TEXT NOT NULL UNIQUE);")
+        # columns are ids in archive_strings, day is an ISO date
+        self.cur.execute("CREATE TABLE IF NOT EXISTS archive_rows("
+                         "id INTEGER PRIMARY KEY,"
+                         "day TEXT NOT NULL,"
+                         "period INT, grade INT, teacher INT, lesson INT,"
+                         "room INT, text INT, orig_teacher INT,"
+                         "orig_lesson INT, orig_room INT);")
+        # one row per grade of rows for several grades ("5a, 5b")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS archive_grades("
+                         "row_id INT NOT NULL,"
+                         "grade TEXT NOT NULL,"
+                         "day TEXT NOT NULL);")
+        # covers the columns of the aggregates, so they don't read the rows
+        self.cur.execute("CREATE INDEX IF NOT EXISTS archive_rows_day "
+                         "ON archive_rows(day, orig_teacher, teacher,"
+                         "orig_room, room)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS archive_rows_teacher "
+                         "ON archive_rows(orig_teacher, day)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS archive_rows_room "
+                         "ON archive_rows(orig_room, day)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS archive_grades_grade "
+                         "ON archive_grades(grade, day)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS archive_grades_row "
+                         "ON archive_grades(row_id)")
+        self.conn.commit()
+        self._ids = {}
+
+    def _string_id(self, value):
+        string_id = self._ids.get(value)
+        if string_id is None:
+            self.cur.execute("INSERT OR IGNORE INTO archive_strings(value) "
+                             "VALUES (?)", (value,))
+            self.cur.execute("SELECT id FROM archive_strings WHERE value=?",
+                             (value,))
+            string_id = self._ids[value] = self.cur.fetchone()[0]
+        return string_id
+
+    def _string_ids(self, value):
+        """
+        ids of all strings equal to value, ignoring case
+        """
+        self.cur.execute("SELECT id FROM archive_strings "
+                         "WHERE value=? COLLATE NOCASE", (value.strip(),))
+        return [row[0] for row in self.cur.fetchall()]
+
+    def add_week(self, week_start, days, digest) -> bool:
+        """
+        archives a version of a week. days is a list of lists of the rows of
+        every day starting with week_start, None for days missing from the
+        page, digest the hash of the page. Returns False if this version was
+        archived before
+        """
+        self.cur.execute("SELECT 1 FROM archive_weeks WHERE digest=?",
+                         (digest,))
+        if self.cur.fetchone() is not None:
+            return False
+
+        data = zlib.compress(pickle.dumps(
+            [None if rows is None else [tuple(row) for row in rows]
+             for rows in days],
+            pickle.HIGHEST_PROTOCOL))
+        self.cur.execute("INSERT INTO archive_weeks"
+                         "(digest, week_start, archived, data) "
+                         "VALUES (?, ?, ?, ?)",
+                         (digest, week_start.isoformat(), int(time.time()),
+                          sqlite3.Binary(data)))
+
+        for offset, rows in enumerate(days):
+            if rows is None:
+                continue # keep what was archived for the day before
+            day = (week_start + datetime.timedelta(days=offset)).isoformat()
+            # the newest version of a day replaces the older ones
+            self.cur.execute("DELETE FROM archive_grades WHERE day=?", (day,))
+            self.cur.execute("DELETE FROM archive_rows WHERE day=?", (day,))
+            for row in rows:
+                self.cur.execute(
+                    "INSERT INTO archive_rows(day, period, grade, teacher,"
+                    "lesson, room, text, orig_teacher, orig_lesson, orig_room)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [day] + [self._string_id(value) for value in row])
+                row_id = self.cur.lastrowid
+                self.cur.executemany(
+                    "INSERT INTO archive_grades(row_id, grade, day) "
+                    "VALUES (?, ?, ?)",
+                    ((row_id, grade.strip().lower(), day)
+                     for grade in set(row[1].split(",")) if grade.strip()))
+        self.conn.commit()
+        return True
+
+    def teacher_absences(self, teacher, start, end) -> int:
+        """
+        number of lessons of teacher between the dates start and end that
+        were given by someone else or cancelled
+        """
+        ids = self._string_ids(teacher)
+        if not ids:
+            return 0
+        self.cur.execute(
+            "SELECT COUNT(*) FROM archive_rows WHERE orig_teacher IN ({}) "
+            "AND teacher != orig_teacher AND day BETWEEN ? AND ?".format(
+                ",".join("?" * len(ids))),
+            ids + [start.isoformat(), end.isoformat()])
+        return self.cur.fetchone()[0]
+
+    def top_absent_teachers(self, start, end, limit=10) -> list:
+        """
+        [(teacher, lessons)] of the teachers that missed the most lessons
+        """
+        # count by id first, so only the results are joined with the strings
+        self.cur.execute(
+            "SELECT s.value, n FROM (SELECT orig_teacher, COUNT(*) AS n "
+            "FROM archive_rows WHERE teacher != orig_teacher "
+            "AND day BETWEEN ? AND ? GROUP BY orig_teacher) "
+            "JOIN archive_strings s ON s.id = orig_teacher "
+            "WHERE s.value != '' ORDER BY n DESC, s.value LIMIT ?",
+            (start.isoformat(), end.isoformat(), limit))
+        return self.cur.fetchall()
+
+    def top_room_changes(self, start, end, limit=10) -> list:
+        """
+        [(room, changes)] of the rooms most often swapped for another one
+        """
+        self.cur.execute(
+            "SELECT s.value, n FROM (SELECT orig_room, COUNT(*) AS n "
+            "FROM archive_rows WHERE room != orig_room "
+            "AND room NOT IN (SELECT id FROM archive_strings "
+            "WHERE value IN ('', '---')) "
+            "AND day BETWEEN ? AND ? GROUP BY orig_room) "
+            "JOIN archive_strings s ON s.id = orig_room "
+            "WHERE s.value != '' ORDER BY n DESC, s.value LIMIT ?",
+            (start.isoformat(), end.isoformat(), limit))
+        return self.cur.fetchall()
+
+    def grade_substitutions(self, grade, start, end) -> int:
+        """
+        number of substitutions of grade between the dates start and end
+        """
+        self.cur.execute("SELECT COUNT(*) FROM archive_grades "
+                         "WHERE grade=? AND day BETWEEN ? AND ?",
+                         (grade.strip().lower(), start.isoformat(),
+                          end.isoformat()))
+        return self.cur.fetchone()[0]
+
+
+class AsyncDatabase:
+    """
+    Runs all database access on one dedicated thread, so slow disk I/O
+    doesn't block the event loop. Calls are queued and executed one after
+    another, which also makes it the only writer to the database.
+
+    The connection and the managers are created on that thread, because
+    sqlite3 connections can only be used by the thread that created them
+    """
+    def __init__(self, path, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.connection = self._executor.submit(connect, path).result()
+
+        self.users = self.open(UserManager, AsyncUserManager)
+        self.substs = self.open(SubstManager)
+        self.broadcasts = self.open(BroadcastManager)
+        self.snapshots = self.open(SnapshotManager)
+        self.archive = self.open(ArchiveManager)
+
+    def open(self, manager_class, wrapper=AsyncManager) -> AsyncManager:
+        """
+        creates a manager for this database on its thread
+        """
+        manager = self._executor.submit(manager_class, self.connection).result()
+        return wrapper(self, manager)
+
+    @asyncio.coroutine
+    def run(self, func, *args):
+        """
+        runs func(*args) on the database thread and returns its result
+        """
+        return (yield from self.loop.run_in_executor(self._executor, func, *args))
+
+    @asyncio.coroutine
+    def commit(self):
+        yield from self.run(self.connection.commit)
+
+    def close(self):
+        # new users that are still pending would be lost otherwise
+        self.users.cancel()
+        self._executor.submit(self.users._manager.flush)
+        self._executor.submit(self.connection.close)
+        self._executor.shutdown()
@@ -2,6 +2,7 @@
 from fabric.api import local, cd, run, put
 from fabric.contrib import files
 from datetime import datetime as dt
+import os
 
 def pip_dump():
     local("pip freeze > requirements.txt")
@@ -10,6 +11,14 @@ def test():
     local("pylint3 *.py -E -j 4 -f colorized")
     local("python test.py")
 
+def bench(baseline="bench_baseline.json"):
+    if not os.path.exists(baseline):
+        print(baseline, "doesn't exist, running without comparison. Create it "
+              "with: python bench.py --save-baseline", baseline)
+        local("python bench.py")
+        return
+    local("python bench.py --baseline " + baseline)
+
 def deploy(directory="~/GSVPlanBot-git"):
     # check if there are uncommitted changes
     local("git diff-index --quiet HEAD --") 
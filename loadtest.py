@@ -0,0 +1,259 @@
+"""
+End-to-end load test for the VPlanBot against local stand-ins for the
+UNTIS server and the Telegram Bot API
+
+    python loadtest.py --chats 2000 --messages 3 --broadcast 5000
+
+Like test.py this imports main.py, which needs a ../keyfile to exist. Its url,
+credentials and database are replaced with the fake servers and an
+in-memory database.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import sys
+import time
+
+from aiohttp import web
+
+import bench
+import main as vplanbot
+
+UNTIS_PATH = "/vplan/w/{weeknum}/w00000.htm"
+
+
+class FakeUntis:
+    """
+    Serves synthetic week pages behind HTTP Basic Auth. Weeks in missing
+    answer 404, and every response is delayed by delay seconds
+    """
+    def __init__(self, user="bench", password="bench", rows=40, delay=0,
+                 missing=()):
+        self.credentials = "Basic " + base64.b64encode(
+            "{}:{}".format(user, password).encode()).decode()
+        self.rows = rows
+        self.delay = delay
+        self.missing = set(missing)
+        self.requests = 0
+        self._pages = {}
+
+    def page(self, weeknum):
+        if weeknum not in self._pages:
+            self._pages[weeknum] = bench.make_week_page(
+                rows=self.rows, seed=weeknum).encode("utf-8")
+        return self._pages[weeknum]
+
+    @asyncio.coroutine
+    def handle(self, request):
+        self.requests += 1
+        if self.delay:
+            yield from asyncio.sleep(self.delay)
+
+        if request.headers.get("Authorization") != self.credentials:
+            return web.Response(status=401)
+
+        weeknum = int(request.match_info["weeknum"])
+        if weeknum in self.missing:
+            return web.Response(status=404)
+
+        etag = '"{}"'.format(weeknum)
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+
+        return web.Response(body=self.page(weeknum), headers={
+            "Content-Type": "text/html; charset=utf-8", "ETag": etag})
+
+    def add_routes(self, app):
+        app.router.add_route("GET", UNTIS_PATH.format(weeknum="{weeknum}"),
+                             self.handle)
+
+
+class FakeTelegram:
+    """
+    Accepts Bot API calls at /bot<token>/<method>. A share of calls given by
+    rate_limited is answered with 429 and retry_after
+    """
+    def __init__(self, rate_limited=0, retry_after=1, delay=0):
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.delay = delay
+        self.calls = {}
+        self.errors = 0
+
+    @asyncio.coroutine
+    def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.delay:
+            yield from asyncio.sleep(self.delay)
+
+        if random.random() < self.rate_limited:
+            self.errors += 1
+            body = {"ok": False, "error_code": 429,
+                    "description": "Too Many Requests",
+                    "parameters": {"retry_after": self.retry_after}}
+            status = 429
+        else:
+            body = {"ok": True, "result": {"message_id": 1}}
+            status = 200
+
+        return web.Response(status=status, body=json.dumps(body).encode(),
+                            headers={"Content-Type": "application/json"})
+
+    def add_routes(self, app):
+        app.router.add_route("POST", "/bot{token}/{method}", self.handle)
+
+
+class LoadTestBot(vplanbot.VPlanBot):
+    """
+    VPlanBot that sends its Bot API calls to a FakeTelegram. Only the URL is
+    replaced, so the calls go through telepot and VPlanBot like in production
+    """
+    def __init__(self, api_url, *args, **kwargs):
+        self.api_url = api_url
+        super().__init__(*args, **kwargs)
+
+    def _methodurl(self, method):
+        return "{}/bot{}/{}".format(self.api_url, self._token, method)
+
+
+@asyncio.coroutine
+def start_servers(loop, untis, telegram, host="127.0.0.1", port=0):
+    """
+    serves both fakes from one local aiohttp app, returns (server, base url)
+    """
+    app = web.Application(loop=loop)
+    untis.add_routes(app)
+    telegram.add_routes(app)
+    server = yield from loop.create_server(app.make_handler(), host, port)
+    port = server.sockets[0].getsockname()[1]
+    return server, "http://{}:{}".format(host, port)
+
+
+def chat_message(chat_id, text):
+    return {
+        "message_id": 1,
+        "from": {"id": chat_id, "first_name": "Last"},
+        "chat": {"id": chat_id, "type": "private"},
+        "date": int(time.time()),
+        "text": text,
+    }
+
+
+def summary(name, latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    return ("{}: {} in {:.1f}s, {:.0f}/s, {} errors, latency p50 {:.0f}ms "
+            "p90 {:.0f}ms p99 {:.0f}ms max {:.0f}ms").format(
+                name, len(latencies), elapsed, len(latencies) / elapsed, errors,
+                1000 * bench.percentile(latencies, 50),
+                1000 * bench.percentile(latencies, 90),
+                1000 * bench.percentile(latencies, 99),
+                1000 * latencies[-1])
+
+
+@asyncio.coroutine
+def drive_messages(bot, chats, messages, concurrency):
+    """
+    sends messages requests from each of chats simulated users with at most
+    concurrency requests in flight and reports their latency. Like in
+    telepot's message loop a failed request doesn't stop the others, it's
+    counted as an error
+    """
+    requests = [(chat_id, str(random.randint(0, 6)))
+                for chat_id in range(1, chats + 1) for _ in range(messages)]
+    random.shuffle(requests)
+    latencies = []
+    errors = []
+
+    @asyncio.coroutine
+    def worker():
+        while requests:
+            chat_id, text = requests.pop()
+            start = time.perf_counter()
+            try:
+                yield from bot.on_chat_message(chat_message(chat_id, text))
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    yield from asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summary("messages", latencies, time.perf_counter() - start,
+                   len(errors))
+
+
+@asyncio.coroutine
+def drive_broadcast(bot, telegram, receivers):
+    """
+    subscribes receivers users to the broadcast and sends it once
+    """
+    for chat_id in range(1, receivers + 1):
+        yield from bot.usermanager.ensure_user(chat_id)
+    yield from bot.usermanager.flush()
+    for chat_id in range(1, receivers + 1):
+        yield from bot.usermanager.set_broadcast(chat_id, True)
+
+    before = telegram.calls.get("sendMessage", 0)
+    start = time.perf_counter()
+    yield from bot.broadcast_message()
+    elapsed = time.perf_counter() - start
+    sent = telegram.calls.get("sendMessage", 0) - before
+    return "broadcast: {} messages in {:.1f}s, {:.0f} msg/s".format(
+        sent, elapsed, sent / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=3,
+                        help="requests per chat")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--broadcast", type=int, default=0,
+                        help="number of broadcast receivers, 0 to skip")
+    parser.add_argument("--rows", type=int, default=40,
+                        help="substitutions per day on the fake pages")
+    parser.add_argument("--untis-delay", type=float, default=0.05)
+    parser.add_argument("--telegram-delay", type=float, default=0.01)
+    parser.add_argument("--rate-limited", type=float, default=0,
+                        help="share of Telegram calls answered with 429")
+    parser.add_argument("--send-rate", type=float, default=1000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    untis = FakeUntis(rows=args.rows, delay=args.untis_delay)
+    telegram = FakeTelegram(rate_limited=args.rate_limited, retry_after=0,
+                            delay=args.telegram_delay)
+    server, base_url = loop.run_until_complete(
+        start_servers(loop, untis, telegram))
+
+    vplanbot.CONFIG.update({
+        "url": base_url + UNTIS_PATH.format(weeknum="{weeknum:02}"),
+        "user": "bench",
+        "pass": "bench",
+        "notify_id": "0",
+        "database": ":memory:",
+        "send_rate": str(args.send_rate),
+        "push_changes": "0",
+    })
+    bot = LoadTestBot(base_url, "LOADTEST")
+
+    try:
+        print(loop.run_until_complete(drive_messages(
+            bot, args.chats, args.messages, args.concurrency)))
+        if args.broadcast:
+            print(loop.run_until_complete(
+                drive_broadcast(bot, telegram, args.broadcast)))
+        print("UNTIS requests: {}, Telegram calls: {}, Telegram errors: {}"
+              .format(untis.requests, sum(telegram.calls.values()),
+                      telegram.errors))
+    finally:
+        bot.readers.close()
+        bot.database.close()
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
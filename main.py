@@ -4,18 +4,23 @@ Main module for the VPlanBot
 import locale
 import logging
 import asyncio
+import signal
 import time
-from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
 import telepot
 import telepot.async
 
-import sqlite3
-
 import aiocron
 
 import reader
 import database
+import broadcast
+import subscriptions
+import metrics
+import plans
+from cache import TTLCache
 
 import colorlog
 
@@ -38,12 +43,35 @@ with open("../keyfile", "r") as f:
             key, value = line.split("=")
             CONFIG[key.strip()] = value.strip()
 
-def format_subst(subst, subst_date):
+FILTER_TIME = metrics.REGISTRY.histogram(
+    "vplanbot_filter_seconds", "time to select the rows for a subscription set")
+FORMAT_TIME = metrics.REGISTRY.histogram(
+    "vplanbot_format_seconds", "time to render a message")
+SEND_TIME = metrics.REGISTRY.histogram(
+    "vplanbot_send_seconds", "time to send a message to Telegram")
+TELEGRAM_ERRORS = metrics.REGISTRY.counter(
+    "vplanbot_telegram_errors_total", "failed calls to Telegram")
+REQUESTS = metrics.REGISTRY.counter(
+    "vplanbot_requests_total", "messages recieved")
+LOOP_LAG = metrics.REGISTRY.histogram(
+    "vplanbot_loop_lag_seconds", "delay of the event loop")
+
+# names of subscription kinds in /abo commands
+KIND_NAMES = {
+    "klasse": "grade",
+    "kurs": "lesson",
+    "lehrer": "teacher",
+}
+
+def format_subst(subst, subst_date, rows=None):
     """
-    Formats a Subst object and adds a preformatted date
+    Formats a Subst object and adds a preformatted date. rows replaces
+    subst.data if given
     """
+    if rows is None:
+        rows = subst.data
     root = "Vertretungen für den {subst_date}\n\n{subst}\n\nNachrichten:\n{news}"
-    sub = "\n".join([format_subst_row(i) for i in subst.data])
+    sub = "\n".join([format_subst_row(i) for i in rows])
     news = "\n".join([" ".join(i) for i in subst.info])
     return root.format(subst_date=subst_date, subst=sub, news=news)
 
@@ -51,6 +79,47 @@ def format_subst(subst, subst_date):
 # orig_lesson='pw76', orig_room='D108')
 
 
+def format_changes(changes):
+    """
+    Formats a list of (date, SubstRecord) tuples of new substitutions
+    """
+    lines = ["Neue Vertretungen:"]
+    last_date = None
+    for subst_date, row in changes:
+        if subst_date != last_date:
+            lines.append("\n" + subst_date.strftime("%A, %d. %B") + ":")
+            last_date = subst_date
+        lines.append(format_subst_row(row))
+    return "\n".join(lines)
+
+
+def is_relevant(row):
+    """
+    filter for the substitutions that are sent to users without subscriptions
+    """
+    return "Q" in row.grade and "3" in row.grade
+
+
+def select_rows(day, subs):
+    """
+    returns the rows of a DayInfo a user with the subscriptions subs gets
+    """
+    if not subs:
+        return [x for x in day.data if is_relevant(x)]
+    return subscriptions.index_for(day).lookup(subs)
+
+
+def group_by_subscriptions(subs_by_chat):
+    """
+    turns {chat_id: subscriptions} into {subscriptions: [chat_id]}, so every
+    distinct filter only has to be applied once
+    """
+    groups = {}
+    for chat_id, subs in subs_by_chat.items():
+        groups.setdefault(subs, []).append(chat_id)
+    return groups
+
+
 def format_subst_row(row):
     """
     formats a specific SubstRecord as a single row
@@ -81,6 +150,97 @@ def format_subst_row(row):
     return "".join(message)
 
 
+# longest range of days that can be requested at once
+MAX_RANGE_DAYS = 14
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+# broadcast receivers loaded from the database at once
+BROADCAST_PAGE_SIZE = 1000
+
+
+def parse_range(text, today):
+    """
+    returns (start, end) of requests like "0-4" for today and the next four
+    days, or "woche" for this school week (next week on weekends). None if
+    text isn't a range
+    """
+    text = text.strip().lower()
+    if text == "woche":
+        monday = today - timedelta(days=today.weekday())
+        if today.weekday() > 4:
+            monday += timedelta(weeks=1)
+        return monday, monday + timedelta(days=4)
+
+    first, sep, last = text.partition("-")
+    if not sep:
+        return None
+    try:
+        first, last = int(first), int(last)
+    except ValueError:
+        return None
+    if not 0 <= last - first < MAX_RANGE_DAYS:
+        return None
+    return today + timedelta(days=first), today + timedelta(days=last)
+
+
+def join_messages(messages, limit=MAX_MESSAGE_LENGTH):
+    """
+    joins messages into as few as possible that are at most limit long
+    """
+    joined = []
+    for message in messages:
+        if joined and len(joined[-1]) + 2 + len(message) <= limit:
+            joined[-1] += "\n\n" + message
+        else:
+            joined.append(message[:limit])
+    return joined
+
+
+def prefetch_interval(now, interval, morning_interval):
+    """
+    seconds until the next prefetch. School-day mornings, when most people
+    ask for today's plan, get the shorter interval
+    """
+    if now.weekday() < 5 and 6 <= now.hour < 9:
+        return morning_interval
+    return interval
+
+
+def school_year_start(today):
+    """
+    first day of the school year today is in, school years start in August
+    """
+    year = today.year if today.month >= 8 else today.year - 1
+    return date(year, 8, 1)
+
+
+def make_parse_executor():
+    """
+    creates the executor pages are parsed in, None to parse on the event loop
+    """
+    workers = int(CONFIG.get("parse_workers", 0))
+    if not workers:
+        return None
+    if CONFIG.get("parse_executor", "process") == "thread":
+        return ThreadPoolExecutor(max_workers=workers)
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def make_reader(options, executor=None):
+    """
+    creates the Reader of a plan from its keys, see plans.plan_configs
+    """
+    rate = options.get("rate")
+    return reader.Reader(options["url"], (options["user"], options["pass"]),
+                         timeout=int(CONFIG.get("timeout", 30)),
+                         conn_limit=int(options.get(
+                             "connections", CONFIG.get("connections", 4))),
+                         parser=CONFIG.get("parser", "bs4"),
+                         columnar=CONFIG.get("columnar", "0") == "1",
+                         rate=float(rate) if rate is not None else None,
+                         executor=executor)
+
+
 class VPlanBot(telepot.async.Bot):
     """
     Main class of the VPlanBot
@@ -88,18 +248,95 @@ class VPlanBot(telepot.async.Bot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.reader = reader.Reader(CONFIG["url"], (CONFIG["user"], CONFIG["pass"]))
+        self.plan_configs = plans.plan_configs(CONFIG)
+        # shared by all plans, so they are parsed in parallel on all cores
+        self.parse_executor = make_parse_executor()
+        self.readers = plans.ReaderPool({
+            name: make_reader(options, self.parse_executor)
+            for name, options in self.plan_configs.items()})
+        self.reader = self.readers.get(plans.DEFAULT)
 
         self.suspend_days = 0
 
+        self.prefetch_interval = int(CONFIG.get("prefetch_interval", 60*10))
+        self.prefetch_morning_interval = int(
+            CONFIG.get("prefetch_morning_interval", 60*2))
+
+        # rendered messages by (week digest, date, subscriptions). A changed
+        # week has a new digest, so outdated messages are never hit again
+        self.render_cache = TTLCache(60*60, maxsize=1024, sizeof=len)
+
+        caches = [("render_cache", self.render_cache)]
+        for plan in self.readers:
+            name = "cache" if plan == plans.DEFAULT else "cache_" + plan
+            caches.append((name, self.readers.get(plan).cache))
+        for name, cache in caches:
+            for stat in ("hits", "misses", "evictions", "entries", "bytes"):
+                metrics.REGISTRY.gauge(
+                    "vplanbot_{}_{}".format(name, stat),
+                    "{} of the {}".format(stat, name.replace("_", " ")),
+                    lambda cache=cache, stat=stat: cache.stats()[stat])
+
+        self.push_changes = CONFIG.get("push_changes", "1") == "1"
+        self._polled_digests = {}
+        self.archive = CONFIG.get("archive", "1") == "1"
+        self._archived_digests = {}
+
         @aiocron.crontab("0 18 * * 0-4")
         #@aiocron.crontab("* * * * * */5")
         @asyncio.coroutine
         def on_broadcast_timer():
             yield from self.broadcast_message()
 
-        self.connection = sqlite3.connect("users.db")
-        self.usermanager = database.UserManager(self.connection)
+        @aiocron.crontab("0 3 * * *")
+        @asyncio.coroutine
+        def on_prune_timer():
+            yield from self.substmanager.prune_older_than(date.today())
+            yield from self.database.snapshots.prune_older_than(
+                time.time() - 14*24*60*60)
+            yield from self.database.commit()
+
+        self.fanout = broadcast.FanOut(
+            self.sendMessage,
+            concurrency=int(CONFIG.get("send_concurrency", 20)),
+            rate=float(CONFIG.get("send_rate", 30)))
+
+        self.broadcast_batch = int(CONFIG.get("broadcast_batch", 100))
+        # older unfinished broadcasts are dropped instead of resumed
+        self.broadcast_max_age = float(CONFIG.get("broadcast_max_age", 12))
+
+        self.database = database.AsyncDatabase(CONFIG.get("database", "users.db"))
+        self.usermanager = self.database.users
+        self.broadcasts = self.database.broadcasts
+        self.substmanager = self.database.substs
+        # restarts start with the weeks parsed before instead of a cold cache
+        for plan in self.readers:
+            self.readers.get(plan).store = self.database.snapshots
+
+    @asyncio.coroutine
+    def _parse(self, response):
+        """
+        telepot's response parsing, but errors keep the retry_after of rate
+        limited requests, see broadcast.telegram_error
+        """
+        try:
+            data = yield from response.json()
+        except ValueError:
+            text = yield from response.text()
+            raise telepot.BadHTTPResponse(response.status, text)
+
+        if data["ok"]:
+            return data["result"]
+        raise broadcast.telegram_error(data)
+
+    @asyncio.coroutine
+    def sendMessage(self, *args, **kwargs):
+        with metrics.timed(SEND_TIME):
+            try:
+                return (yield from super().sendMessage(*args, **kwargs))
+            except telepot.TelegramError:
+                TELEGRAM_ERRORS.inc()
+                raise
 
     @asyncio.coroutine
     def on_chat_message(self, msg):
@@ -108,6 +345,7 @@ class VPlanBot(telepot.async.Bot):
         """
         starttime = time.time()
         content_type, chat_type, chat_id = telepot.glance(msg)
+        REQUESTS.inc()
 
         yield from self.sendChatAction(chat_id, "typing")
 
@@ -115,26 +353,23 @@ class VPlanBot(telepot.async.Bot):
 
         logger.debug(msg)
 
-        if not self.usermanager.is_user(chat_id):
-            self.usermanager.create_user(chat_id)
+        yield from self.usermanager.ensure_user(chat_id)
 
         # ideally I would use msg.entities, but I'm a lazy fuck
         if msg["text"].startswith("/broadcast"):
-            self.usermanager.set_broadcast(chat_id, True)
+            yield from self.usermanager.set_broadcast(chat_id, True)
             yield from self.sendMessage(chat_id,
                 "Du wirst in Zukunft jeden Tag um 20:00 den Stundenplan erhalten")
             return
 
         if msg["text"].startswith("/msg") and chat_id == int(CONFIG["notify_id"]):
             logger.info("sending message to all members")
-            recievers = self.usermanager.get_all_users()
-            for user_id in recievers:
-                logging.debug("sending to %s", user_id)
-                try:
-                    yield from self.sendMessage(user_id, msg["text"][4:])
-                except telepot.TelegramError:
-                    logging.error("failed to send /msg to {}".format(user_id))
+            yield from self.usermanager.flush()
+            job_id = yield from self.broadcasts.create_job_for_all_users(
+                msg["text"][4:])
+            report = yield from self.run_broadcast_job(job_id, msg["text"][4:])
             logging.info("sent to all members")
+            yield from self.sendMessage(CONFIG["notify_id"], report)
             return
 
         if msg["text"].startswith("/disable") and chat_id == int(CONFIG["notify_id"]):
@@ -145,14 +380,86 @@ class VPlanBot(telepot.async.Bot):
                     "suspending broadcast for {} more days".format(days))
             return
 
+        if msg["text"].startswith("/cache") and chat_id == int(CONFIG["notify_id"]):
+            caches = "\n".join("{}: {}".format(plan, self.readers.get(plan).cache)
+                               for plan in self.readers)
+            yield from self.sendMessage(CONFIG["notify_id"],
+                    "Cache:\n{}\n\nRendered messages:\n{}".format(
+                        caches, self.render_cache))
+            return
+
+        if msg["text"].startswith("/stats") and chat_id == int(CONFIG["notify_id"]):
+            yield from self.sendMessage(CONFIG["notify_id"],
+                    metrics.REGISTRY.summary())
+            return
+
+        if msg["text"].startswith("/archiv") and chat_id == int(CONFIG["notify_id"]):
+            report = yield from self.archive_report(msg["text"].split()[1:])
+            yield from self.sendMessage(CONFIG["notify_id"], report)
+            return
+
         if msg["text"].startswith("/start"):
             yield from self.sendMessage(chat_id,
                 "Wilkommen beim GSVPlanBot!\n"
                 "Gib eine Zahl ein, wie viele Tage in der zukunft du"
-                "den VPlan erhalten willst. Z.B. 0 für heute, 1 für morgen\n\n"
+                "den VPlan erhalten willst. Z.B. 0 für heute, 1 für morgen\n"
+                "Mehrere Tage bekommst du mit z.B. 0-4 oder woche\n\n"
+                "Mit /abo klasse Q34, /abo kurs pw76 oder /abo lehrer Mu "
+                "bekommst du nur die Vertretungen, die dich betreffen\n\n"
                 "bei Fragen und Problemen an Adrian (auf tg @notafile) wenden")
             return
 
+        if msg["text"].startswith("/plan"):
+            reply = yield from self.choose_plan(chat_id, msg["text"].split()[1:])
+            yield from self.sendMessage(chat_id, reply)
+            return
+
+        if msg["text"].startswith("/abos"):
+            subs = yield from self.usermanager.get_subscriptions(chat_id)
+            names = {kind: name for name, kind in KIND_NAMES.items()}
+            lines = sorted("{} {}".format(names[kind], value)
+                           for kind, value in subs)
+            yield from self.sendMessage(chat_id,
+                "Deine Abos:\n" + "\n".join(lines) if lines else
+                "Du hast keine Abos und bekommst die Vertretungen der Q3")
+            return
+
+        if msg["text"].startswith(("/abo", "/deabo")):
+            parts = msg["text"].split()
+            if len(parts) != 3 or parts[1].lower() not in KIND_NAMES:
+                yield from self.sendMessage(chat_id,
+                    "Benutzung: {} klasse|kurs|lehrer NAME".format(parts[0]))
+                return
+            kind = KIND_NAMES[parts[1].lower()]
+            value = subscriptions.normalize(parts[2])
+            if parts[0] == "/abo":
+                yield from self.usermanager.subscribe(chat_id, kind, value)
+                reply = "{} {} abonniert".format(parts[1], parts[2])
+            else:
+                yield from self.usermanager.unsubscribe(chat_id, kind, value)
+                reply = "{} {} nicht mehr abonniert".format(parts[1], parts[2])
+            yield from self.sendMessage(chat_id, reply)
+            return
+
+        day_range = parse_range(msg["text"], date.today())
+        if day_range is not None:
+            subs = yield from self.usermanager.get_subscriptions(chat_id)
+            plan = yield from self.usermanager.get_plan(chat_id)
+            try:
+                messages = yield from self.render_range(
+                    day_range[0], day_range[1], subs, plan)
+            except Exception as e:
+                logger.exception("could not get range")
+                yield from self.sendMessage(chat_id, "Error - could not get")
+                notification = "request failed:\n{}\n{}".format(msg, e)
+                yield from self.sendMessage(CONFIG["notify_id"], notification)
+                return
+            if not messages:
+                messages = ["Für diese Tage ist keine Vertretung verfügbar"]
+            for message in join_messages(messages):
+                yield from self.sendMessage(chat_id, message)
+            return
+
         try:
             num = int(msg["text"])
         except ValueError:
@@ -162,8 +469,10 @@ class VPlanBot(telepot.async.Bot):
 
         if num is not None:
             day = date.today() + timedelta(days=num)
+            subs = yield from self.usermanager.get_subscriptions(chat_id)
+            plan = yield from self.usermanager.get_plan(chat_id)
             try:
-                result = self.reader.get_day(day)
+                message = yield from self.render_day(day, subs, plan)
             except reader.NoSubstError:
                 logger.info("no subst available for request")
                 yield from self.sendMessage(chat_id, "Für diesen Tag ist keine Vertretung verfügbar")
@@ -175,17 +484,231 @@ class VPlanBot(telepot.async.Bot):
                 yield from self.sendMessage(CONFIG["notify_id"], notification)
                 return
 
-            result.data = [x for x in result.data if "Q" in x.grade and "3" in x.grade]
-
-            logging.info(result.headers)
-            logging.info(result.data)
-
-            message = format_subst(result, day.strftime("%A, %d. %B"))
-
         logger.info("Sending message - %ss", time.time()-starttime)
         yield from self.sendMessage(chat_id, message)
         logger.info("Sent message - %s", time.time()-starttime)
 
+    @asyncio.coroutine
+    def choose_plan(self, chat_id, args):
+        """
+        answers /plan: without arguments the available plans, otherwise
+        switches the user to the plan given
+        """
+        current = (yield from self.usermanager.get_plan(chat_id)) or plans.DEFAULT
+        if not args:
+            lines = ["{}{} {}".format("* " if plan == current else "", plan,
+                                      self.plan_configs[plan].get("title", ""))
+                     .rstrip() for plan in self.readers]
+            return ("Verfügbare Pläne:\n" + "\n".join(lines) +
+                    "\n\nMit /plan NAME wechselst du den Plan")
+
+        plan = args[0].lower()
+        if plan not in self.readers:
+            return "Den Plan {} gibt es nicht".format(args[0])
+        yield from self.usermanager.set_plan(
+            chat_id, None if plan == plans.DEFAULT else plan)
+        return "Du bekommst jetzt den Plan {}".format(plan)
+
+    @asyncio.coroutine
+    def render_day(self, day, subs, plan=None):
+        """
+        returns the message with the substitutions on day for subscriptions
+        subs from the plan named plan. Each message is rendered once per
+        version of the week
+        """
+        snapshot = yield from self.readers.get(plan).get_snapshot(
+            day.isocalendar()[1])
+
+        key = (snapshot.digest, day, subs)
+        message = self.render_cache.get(key)
+        if message is None:
+            result = reader.find_day(snapshot.week, day.weekday())
+
+            with metrics.timed(FILTER_TIME):
+                rows = select_rows(result, subs)
+            with metrics.timed(FORMAT_TIME):
+                message = format_subst(result, day.strftime("%A, %d. %B"), rows)
+            self.render_cache[key] = message
+        return message
+
+    @asyncio.coroutine
+    def render_range(self, start, end, subs, plan=None):
+        """
+        returns the messages of render_day for all school days from start to
+        end. The weeks are loaded concurrently first
+        """
+        yield from self.readers.get(plan).get_range(start, end)
+
+        messages = []
+        day = start
+        while day <= end:
+            if day.weekday() < 5:
+                try:
+                    messages.append((yield from self.render_day(day, subs, plan)))
+                except reader.RequestError as e:
+                    logger.info("no substitutions for %s: %s", day, e)
+            day += timedelta(days=1)
+        return messages
+
+    @asyncio.coroutine
+    def prefetch(self, plan=None):
+        """
+        refreshes the current and next week of a plan so requests are served
+        from cache
+        """
+        today = date.today()
+        for day in (today, today + timedelta(weeks=1)):
+            weeknum = day.isocalendar()[1]
+            try:
+                yield from self.readers.get(plan).refresh(weeknum)
+            except reader.RequestError as e:
+                logger.warning("prefetching week %s of %s failed: %s",
+                               weeknum, plan or plans.DEFAULT, e)
+
+    @asyncio.coroutine
+    def poll_changes(self, plan=None):
+        """
+        registers the substitutions of today and the rest of the current and
+        next week of a plan and pushes the ones that weren't seen before to
+        the broadcast subscribers of that plan
+        """
+        today = date.today()
+        monday = today - timedelta(days=today.weekday())
+
+        # on the very first poll everything is new, don't push all of it
+        first_poll = not (yield from self.substmanager.is_initialized(plan))
+
+        polled = []
+        loaded = False
+        for week_start in (monday, monday + timedelta(weeks=1)):
+            weeknum = week_start.isocalendar()[1]
+            try:
+                snapshot = yield from self.readers.get(plan).get_snapshot(
+                    weeknum)
+            except reader.RequestError as e:
+                logger.warning("polling week %s failed: %s", weeknum, e)
+                continue
+            loaded = True
+
+            if self._polled_digests.get((plan, weeknum)) == snapshot.digest:
+                continue
+            self._polled_digests[(plan, weeknum)] = snapshot.digest
+
+            for day in snapshot.week:
+                subst_date = week_start + timedelta(days=day.weekday - 1)
+                if subst_date < today:
+                    continue
+                polled.extend((row, subst_date) for row in day.data)
+
+        changes = yield from self.substmanager.register_new(polled, plan)
+        yield from self.database.commit()
+        if first_poll and loaded:
+            yield from self.substmanager.mark_initialized(plan)
+
+        if first_poll or not changes:
+            return
+
+        logger.info("%s new substitutions", len(changes))
+        groups = yield from self.broadcast_groups()
+        groups = {subs: recievers
+                  for (user_plan, subs), recievers in groups.items()
+                  if user_plan == plan}
+        for subs, recievers in groups.items():
+            if subs:
+                relevant = [(d, row) for row, d in changes
+                            if subscriptions.matches(row, subs)]
+            else:
+                relevant = [(d, row) for row, d in changes if is_relevant(row)]
+            if not relevant:
+                continue
+
+            message = format_changes(relevant)
+            job_id = yield from self.broadcasts.create_job(message, recievers)
+            yield from self.run_broadcast_job(job_id, message)
+
+    @asyncio.coroutine
+    def archive_weeks(self):
+        """
+        adds the current and next week to the archive if they changed
+        """
+        today = date.today()
+        monday = today - timedelta(days=today.weekday())
+        for week_start in (monday, monday + timedelta(weeks=1)):
+            weeknum = week_start.isocalendar()[1]
+            try:
+                snapshot = yield from self.reader.get_snapshot(weeknum)
+            except reader.RequestError as e:
+                logger.warning("archiving week %s failed: %s", weeknum, e)
+                continue
+
+            if self._archived_digests.get(weeknum) == snapshot.digest:
+                continue
+            # copied here, the database thread must not parse a LazyWeek
+            days = [None] * 5
+            for day in snapshot.week:
+                if 1 <= day.weekday <= 5:
+                    days[day.weekday - 1] = list(day.data)
+            if (yield from self.database.archive.add_week(
+                    week_start, days, snapshot.digest)):
+                logger.info("archived new version of week %s", weeknum)
+            self._archived_digests[weeknum] = snapshot.digest
+
+    @asyncio.coroutine
+    def archive_report(self, args):
+        """
+        answers the admin command /archiv for the current school year:
+        /archiv lehrer [name], /archiv klasse name or /archiv raeume
+        """
+        end = date.today()
+        start = school_year_start(end)
+        archive = self.database.archive
+        kind, value = (args + [None, None])[:2]
+
+        if kind == "lehrer" and value:
+            count = yield from archive.teacher_absences(value, start, end)
+            return "{}: {} lessons missed since {}".format(value, count, start)
+        if kind == "lehrer":
+            top = yield from archive.top_absent_teachers(start, end)
+            return "lessons missed since {}:\n{}".format(
+                start, "\n".join("{} {}".format(*row) for row in top))
+        if kind == "klasse" and value:
+            count = yield from archive.grade_substitutions(value, start, end)
+            return "{}: {} substitutions since {}".format(value, count, start)
+        if kind == "raeume":
+            top = yield from archive.top_room_changes(start, end)
+            return "room changes since {}:\n{}".format(
+                start, "\n".join("{} {}".format(*row) for row in top))
+        return "usage: /archiv lehrer [name] | klasse name | raeume"
+
+    @asyncio.coroutine
+    def refresh_plan(self, name):
+        """
+        prefetches a plan, archives it and pushes its changes
+        """
+        plan = None if name == plans.DEFAULT else name
+        yield from self.prefetch(plan)
+        if self.archive and plan is None:
+            try:
+                yield from self.archive_weeks()
+            except Exception:
+                logger.exception("archiving failed")
+        if self.push_changes:
+            try:
+                yield from self.poll_changes(plan)
+            except Exception:
+                logger.exception("polling for changes failed")
+
+    @asyncio.coroutine
+    def prefetch_loop(self):
+        """
+        refreshes all plans forever, one after another spread over the
+        prefetch interval
+        """
+        scheduler = plans.Scheduler(self.readers, lambda: prefetch_interval(
+            datetime.now(), self.prefetch_interval,
+            self.prefetch_morning_interval))
+        yield from scheduler.run(self.refresh_plan)
+
     @asyncio.coroutine
     def send_timetable(self):
         """
@@ -201,33 +724,100 @@ class VPlanBot(telepot.async.Bot):
             self.suspend_days -= 1
             return
 
-        recievers = self.usermanager.get_broadcasters()
-        logging.debug("sending daily message to: %s", recievers)
+        groups = yield from self.broadcast_groups()
+        recievers = sum(len(chat_ids) for chat_ids in groups.values())
+        logging.debug("sending daily message to %s users", recievers)
 
         yield from self.sendMessage(CONFIG["notify_id"], "sending daily messages")
         logging.info("sending daily messages")
 
         day = date.today() + timedelta(days=1)
+        messages = {}
         try:
-            result = self.reader.get_day(day)
+            for plan, subs in groups:
+                messages[plan, subs] = yield from self.render_day(day, subs, plan)
         except:
             yield from self.sendMessage(CONFIG["notify_id"], "Error getting daily")
             return
 
-        result.data = [x for x in result.data if "Q" in x.grade and "3" in x.grade]
-
-        message = format_subst(result, day.strftime("%A, %d. %B"))
-
-        for chat_id in recievers:
-            try:
-                yield from self.sendMessage(chat_id, message)
-            except telepot.TelegramError:
-                logging.error("could not send message to {}".format(chat_id))
+        reports = []
+        for key, chat_ids in groups.items():
+            message = messages[key]
+            job_id = yield from self.broadcasts.create_job(message, chat_ids)
+            reports.append((yield from self.run_broadcast_job(job_id, message)))
 
-        notification = "sent daily messages to {} users".format(len(recievers))
+        notification = "sent daily messages to {} users\n{}".format(
+            recievers, "\n".join(reports))
         yield from self.sendMessage(CONFIG["notify_id"], notification)
         logger.info(notification)
 
+    @asyncio.coroutine
+    def broadcast_groups(self):
+        """
+        returns {(plan, subscriptions): [chat_id]} of all broadcast
+        receivers. Users of different plans with the same subscriptions get
+        different messages. The receivers are loaded and grouped a page at a
+        time, so only their chat ids are kept
+        """
+        user_plans = yield from self.usermanager.get_plans()
+        groups = {}
+        after = None
+        while True:
+            page = yield from self.usermanager.get_broadcast_page(
+                after, BROADCAST_PAGE_SIZE)
+            if not page:
+                return groups
+            after = page[-1][0]
+            page_groups = group_by_subscriptions(
+                {chat_id: (user_plans.get(chat_id), subs)
+                 for chat_id, subs in page})
+            for key, chat_ids in page_groups.items():
+                groups.setdefault(key, []).extend(chat_ids)
+
+    @asyncio.coroutine
+    def run_broadcast_job(self, job_id, message):
+        """
+        sends a broadcast job to all its pending recipients in batches,
+        storing the delivery state after every batch
+        """
+        start = time.time()
+        while True:
+            batch = yield from self.broadcasts.pending_recipients(
+                job_id, self.broadcast_batch)
+            if not batch:
+                break
+
+            result = yield from self.fanout.run(batch, message)
+            yield from self.broadcasts.set_state(
+                job_id, result.sent, database.BroadcastManager.SENT)
+            yield from self.broadcasts.set_state(
+                job_id, result.failed, database.BroadcastManager.FAILED)
+
+        yield from self.broadcasts.finish_job(job_id)
+        counts = yield from self.broadcasts.job_counts(job_id)
+        return "job {}: {} sent, {} failed in {:.1f}s".format(
+            job_id, counts[database.BroadcastManager.SENT],
+            counts[database.BroadcastManager.FAILED], time.time() - start)
+
+    @asyncio.coroutine
+    def resume_broadcasts(self):
+        """
+        finishes broadcast jobs that were interrupted by a restart. Jobs
+        older than broadcast_max_age hours are outdated and given up
+        """
+        expired = yield from self.broadcasts.expire_jobs(
+            time.time() - self.broadcast_max_age*60*60)
+        for job_id, message in expired:
+            logger.warning("giving up outdated broadcast job %s", job_id)
+            yield from self.sendMessage(CONFIG["notify_id"],
+                "gave up outdated broadcast job {}:\n{}".format(job_id, message))
+
+        for job_id, message in (yield from self.broadcasts.unfinished_jobs()):
+            logger.info("resuming broadcast job %s", job_id)
+            report = yield from self.run_broadcast_job(job_id, message)
+            yield from self.sendMessage(CONFIG["notify_id"],
+                                        "resumed broadcast " + report)
+
     @asyncio.coroutine
     def on_start(self, glance, msg):
         """
@@ -242,6 +832,20 @@ if __name__ == "__main__":
     loop = asyncio.get_event_loop()
 
     loop.create_task(bot.messageLoop())
+    loop.create_task(bot.prefetch_loop())
+    loop.create_task(bot.resume_broadcasts())
+    loop.create_task(metrics.sample_loop_lag(LOOP_LAG))
+
+    if "metrics_port" in CONFIG:
+        loop.run_until_complete(metrics.serve(port=int(CONFIG["metrics_port"])))
+
+    # systemctl restart sends SIGTERM
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
 
     logger.info("Listening for messages...")
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    finally:
+        # writes the new users that are still pending
+        bot.database.close()
+        bot.readers.close()
@@ -0,0 +1,178 @@
+"""
+Counters and timing histograms for the hot paths of the bot, exported in
+the Prometheus text format
+"""
+from contextlib import contextmanager
+import asyncio
+import bisect
+import time
+
+from aiohttp import web
+
+# upper bounds in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return ["# TYPE {} counter".format(self.name),
+                "{} {}".format(self.name, self.value)]
+
+    def summary(self):
+        return "{}: {}".format(self.name, self.value)
+
+
+class Gauge:
+    """
+    value read from a function when the metrics are collected, e.g. the
+    counters of a TTLCache
+    """
+    def __init__(self, name, description, func):
+        self.name = name
+        self.description = description
+        self.func = func
+
+    def render(self):
+        return ["# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, self.func())]
+
+    def summary(self):
+        return "{}: {}".format(self.name, self.func())
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        upper bound of the bucket the q quantile falls into
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = ["# TYPE {} histogram".format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                self.name, bound, cumulative))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, self.count))
+        return lines
+
+    def summary(self):
+        mean = self.sum / self.count if self.count else 0
+        return "{}: {}, avg {:.0f}ms, p50 <{}s, p99 <{}s".format(
+            self.name, self.count, 1000 * mean, self.quantile(0.5),
+            self.quantile(0.99))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description) -> Counter:
+        return self._register(Counter(name, description))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def gauge(self, name, description, func) -> Gauge:
+        # replaces an older gauge of the same name, its function may refer
+        # to an object that doesn't exist anymore
+        self.metrics[name] = Gauge(name, description, func)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        """
+        all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append("# HELP {} {}".format(name, metric.description))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        one human readable line per metric, for the /stats command
+        """
+        return "\n".join(self.metrics[name].summary()
+                         for name in sorted(self.metrics))
+
+
+REGISTRY = Registry()
+
+
+@contextmanager
+def timed(histogram):
+    """
+    observes the time spent in the with block
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+@asyncio.coroutine
+def sample_loop_lag(histogram, interval=1, loop=None):
+    """
+    observes how much later than requested a sleep wakes up, which is the
+    time the event loop was blocked
+    """
+    loop = loop or asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        yield from asyncio.sleep(interval, loop=loop)
+        histogram.observe(max(0, loop.time() - start - interval))
+
+
+@asyncio.coroutine
+def serve(registry=REGISTRY, host="127.0.0.1", port=9100, loop=None):
+    """
+    serves the metrics of registry at http://host:port/metrics
+    """
+    loop = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def handle(request):
+        return web.Response(body=registry.render().encode("utf-8"), headers={
+            "Content-Type": "text/plain; version=0.0.4"})
+
+    app = web.Application(loop=loop)
+    app.router.add_route("GET", "/metrics", handle)
+    return (yield from loop.create_server(app.make_handler(), host, port))
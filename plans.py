@@ -0,0 +1,99 @@
+"""
+Several UNTIS plans, like the student and teacher plans of a school or the
+plans of several schools, served from one bot
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT = "default"
+
+# keys of a plan, given as name.key in the keyfile
+PLAN_KEYS = ("url", "user", "pass", "connections", "rate", "title")
+
+
+def plan_configs(config) -> dict:
+    """
+    returns {name: {key: value}} of the plans in config. The default plan
+    uses the keys url, user and pass, the names of further plans are listed
+    in plans and their keys are prefixed with the name, e.g. lehrer.url.
+    Names are lowercased, like the names users choose with /plan
+    """
+    configs = {DEFAULT: {key: config[key] for key in PLAN_KEYS
+                         if key in config}}
+    names = [name.strip() for name in config.get("plans", "").split(",")]
+    for name in filter(None, names):
+        configs[name.lower()] = {key: config[name + "." + key]
+                                 for key in PLAN_KEYS
+                                 if name + "." + key in config}
+    return configs
+
+
+class ReaderPool:
+    """
+    The Readers of all plans by name. Every Reader has its own cache,
+    connections and request budget
+    """
+    def __init__(self, readers):
+        """
+        readers: {name: reader.Reader}, must contain DEFAULT
+        """
+        self.readers = readers
+
+    def get(self, name):
+        """
+        returns the Reader of the plan name. None and plans that were
+        removed from the config give the default plan
+        """
+        try:
+            return self.readers[name or DEFAULT]
+        except KeyError:
+            logger.warning("unknown plan %s, using the default", name)
+            return self.readers[DEFAULT]
+
+    def __contains__(self, name):
+        return name in self.readers
+
+    def __iter__(self):
+        return iter(sorted(self.readers))
+
+    def __len__(self):
+        return len(self.readers)
+
+    def close(self):
+        for vplan in self.readers.values():
+            vplan.close()
+
+
+class Scheduler:
+    """
+    Runs a job for every plan in turn, spread evenly over an interval, so
+    the plans aren't all refreshed at the same moment
+    """
+    def __init__(self, names, interval, loop=None):
+        """
+        names: the plans to run the job for
+        interval: function returning the seconds until a plan runs again
+        """
+        self.names = list(names)
+        self.interval = interval
+        self.loop = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def run(self, job):
+        """
+        runs the coroutine job(name) for one plan after another forever
+        """
+        while True:
+            for name in self.names:
+                start = self.loop.time()
+                try:
+                    yield from job(name)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("scheduled job for plan %s failed", name)
+                slot = self.interval() / len(self.names)
+                yield from asyncio.sleep(
+                    max(0, slot - (self.loop.time() - start)), loop=self.loop)
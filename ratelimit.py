@@ -0,0 +1,35 @@
+"""
+Rate limiting for the requests to Telegram and the UNTIS servers
+"""
+import asyncio
+
+
+class TokenBucket:
+    """
+    Allows rate acquisitions per second on average, with bursts of up to
+    capacity
+    """
+    def __init__(self, rate, capacity=None, loop=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.loop = loop or asyncio.get_event_loop()
+        self.tokens = self.capacity
+        self._last = self.loop.time()
+
+    @asyncio.coroutine
+    def acquire(self):
+        """
+        waits until a token is available and takes it
+        """
+        while True:
+            now = self.loop.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            yield from asyncio.sleep((1 - self.tokens) / self.rate,
+                                     loop=self.loop)
@@ -2,58 +2,45 @@
 Module to download substitutions from the UNITS substitution system
 """
 from bs4 import BeautifulSoup
-from datetime import datetime
+import lxml.etree
+import lxml.html
+from datetime import datetime, timedelta
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import array
+import bisect
+import hashlib
+import re
+import sys
 import time
 
-import requests
-
 import asyncio
 import aiohttp
 import logging
 
+from cache import TTLCache
+from ratelimit import TokenBucket
+import metrics
+
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_TIME = metrics.REGISTRY.histogram(
+    "vplanbot_download_seconds", "time to download a week page from UNTIS")
+PARSE_TIME = metrics.REGISTRY.histogram(
+    "vplanbot_parse_seconds", "time to parse a week page")
+UNTIS_ERRORS = metrics.REGISTRY.counter(
+    "vplanbot_untis_errors_total", "failed requests to UNTIS")
+
 Record = namedtuple("SubstRecord",
         ["period", "grade", "teacher", "lesson", "room", "text", "orig_teacher", "orig_lesson", "orig_room"])
+SubstRecord = Record # pickle looks the class up by its name
 
-class MWT(object):
-    """Memoize With Timeout"""
-    _caches = {}
-    _timeouts = {}
+# a downloaded page. text is None if the server answered 304 Not Modified
+Page = namedtuple("Page", ["status", "text", "etag", "last_modified"])
 
-    def __init__(self,timeout=2):
-        self.timeout = timeout
-
-    def collect(self):
-        """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
-
-    def __call__(self, f):
-        self.cache = self._caches[f] = {}
-        self._timeouts[f] = self.timeout
-
-        def func(*args, **kwargs):
-            kw = sorted(kwargs.items())
-            key = (args, tuple(kw))
-            try:
-                v = self.cache[key]
-                logger.debug("request served from cache")
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                logger.debug("request missed cache")
-                v = self.cache[key] = f(*args,**kwargs),time.time()
-                self.collect()
-            return v[0]
-        func.func_name = f.__name__
-
-        return func
+# a parsed week together with the validators of the page it was parsed from
+Snapshot = namedtuple("Snapshot",
+        ["week", "digest", "etag", "last_modified", "fetched"])
 
 class RequestError(Exception):
     """
@@ -69,80 +56,353 @@ class Reader:
     """
     Reader objecs are used to request subsitutions from a specific instance of UNITS
     """
-    def __init__(self, url, auth):
+    def __init__(self, url, auth, loop=None, timeout=30, conn_limit=4,
+                 keepalive=60, cache_ttl=60*15, cache_size=16,
+                 cache_bytes=8*1024*1024, parser="bs4", columnar=False,
+                 store=None, rate=None, executor=None):
         """
         url: URL with {weeknum:02} formatting to insert week number
         auth: (username, password)
+        loop: asyncio event loop, defaults to the current one
+        timeout: seconds until a request to UNTIS is given up
+        conn_limit: maximum number of simultaneous connections to UNTIS
+        keepalive: seconds an idle connection is kept open for reuse
+        cache_ttl: seconds a parsed week is served from cache
+        cache_size: maximum number of weeks in the cache
+        cache_bytes: maximum size of all cached weeks
+        parser: name of the parser backend in PARSERS
+        columnar: store the rows of parsed weeks as RecordTables
+        store: persistent storage of snapshots with the coroutines load(url)
+            and save(url, snapshot), like database.SnapshotManager
+        rate: maximum requests per second to UNTIS, None for no limit
+        executor: concurrent.futures executor to parse pages in, None to
+            parse on the event loop
         """
         self.url = url
         self.auth = auth
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.conn_limit = conn_limit
+        self.keepalive = keepalive
+        self.cache = TTLCache(cache_ttl, maxsize=cache_size,
+                              maxbytes=cache_bytes,
+                              sizeof=lambda snapshot: week_size(snapshot.week))
+        self.executor = executor
+        if executor is not None and parser == "lazy":
+            # a LazyWeek parses when it is used, which is on the event loop
+            logger.warning("the lazy parser can't run in an executor, "
+                           "using lxml")
+            parser = "lxml"
+        self.parser = PARSERS[parser]
+        self.columnar = columnar
+        self.store = store
+        self.budget = None
+        if rate is not None:
+            self.budget = TokenBucket(rate, capacity=max(1, rate), loop=self.loop)
+        self._restored = set() # urls already looked up in the store
+        self._session = None
+        self._inflight = {}
+        # last snapshot of every url, kept after the cache entry has expired
+        # to revalidate it with a conditional GET
+        self._snapshots = {}
+
+    @property
+    def session(self):
+        """
+        ClientSession shared by all requests of this reader, so connections
+        to the UNTIS host are pooled and kept alive
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.conn_limit,
+                                             keepalive_timeout=self.keepalive,
+                                             loop=self.loop)
+            self._session = aiohttp.ClientSession(
+                connector=connector, auth=aiohttp.BasicAuth(*self.auth),
+                loop=self.loop)
+        return self._session
+
+    def close(self):
+        """
+        Closes the shared session and all pooled connections
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     @asyncio.coroutine
-    def fetch(self, url):
+    def fetch(self, url, headers=None) -> Page:
         """
         Fetches the UNTIS website with auth
         """
-        b_auth = aiohttp.BasicAuth(self.auth)
-        with aiohttp.ClientSession(auth=b_auth) as session:
-            with session.get(url) as response:
-                print(response.status)
+        if self.budget is not None:
+            yield from self.budget.acquire()
+        try:
+            return (yield from asyncio.wait_for(self._fetch(url, headers),
+                                                self.timeout, loop=self.loop))
+        except asyncio.TimeoutError:
+            raise RequestError("Timeout getting VPlan")
+        except (aiohttp.ClientError, OSError):
+            raise RequestError("Error getting VPlan")
 
+    @asyncio.coroutine
+    def _fetch(self, url, headers):
+        response = yield from self.session.get(url, headers=headers)
+
+        if response.status == 401:
+            response.release()
+            raise RequestError("Invalid Authentication")
+
+        if response.status == 404:
+            response.release()
+            raise RequestError("not found")
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+
+        if response.status == 304:
+            response.release()
+            return Page(304, None, etag, last_modified)
+
+        text = yield from response.text()
+        return Page(response.status, text, etag, last_modified)
+
+    @asyncio.coroutine
     def get_day(self, date) -> list:
         """
-        gets the substitutions for a specific day
+        gets the substitutions for a specific day. The result is shared with
+        the cache and must not be modified
         """
         weeknum = date.isocalendar()[1]
-        weekday = date.weekday()
 
-        url = self.url.format(weeknum=weeknum)
+        week = yield from self.get_week(weeknum)
 
-        vplan = self._parse_page(self._download(url))
+        return find_day(week, date.weekday())
+
+    @asyncio.coroutine
+    def get_range(self, start, end) -> list:
+        """
+        gets the substitutions for all days from start to end, inclusive.
+        The ISO weeks they are in are downloaded concurrently, and weeks
+        that can't be loaded are left out unless all of them fail
+        """
+        dates = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        weeknums = []
+        for d in dates:
+            if d.isocalendar()[1] not in weeknums:
+                weeknums.append(d.isocalendar()[1])
+
+        results = yield from asyncio.gather(
+            *[self.get_week(weeknum) for weeknum in weeknums],
+            loop=self.loop, return_exceptions=True)
+        weeks = {}
+        for weeknum, result in zip(weeknums, results):
+            if isinstance(result, RequestError):
+                logger.info("week %s of range not available: %s", weeknum, result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                weeks[weeknum] = result
+        if not weeks and results:
+            raise results[0]
+
+        res = []
+        for d in dates:
+            week = weeks.get(d.isocalendar()[1])
+            if week is None:
+                continue
+            try:
+                res.append(find_day(week, d.weekday()))
+            except NoSubstError:
+                pass # weekends and days missing from the page
+        return res
+
+    @asyncio.coroutine
+    def get_week(self, weeknum) -> list:
+        """
+        gets the DayInfo objects of all days in an ISO week
+        """
+        snapshot = yield from self.get_snapshot(weeknum)
+        return snapshot.week
+
+    @asyncio.coroutine
+    def get_snapshot(self, weeknum) -> Snapshot:
+        """
+        gets the parsed week and its validators for an ISO week.
+
+        Concurrent calls for the same week wait for the same download and
+        parse instead of each sending their own request to UNTIS
+        """
+        url = self.url.format(weeknum=weeknum)
 
         try:
-            res = find(vplan)[weekday]
-        except IndexError:
-            raise NoSubstError("No substitution for this day")
+            snapshot = self.cache[url]
+            logger.debug("request served from cache")
+            return snapshot
+        except KeyError:
+            logger.debug("request missed cache")
 
-        return res
+        return (yield from self._load_shared(url))
 
-    def _next_schoolday(self, day):
+    @asyncio.coroutine
+    def refresh(self, weeknum) -> Snapshot:
         """
-        gets the next schoolday after a date
+        reloads an ISO week even if it is still cached, to keep it warm
         """
-        pass
+        url = self.url.format(weeknum=weeknum)
+        return (yield from self._load_shared(url))
 
-    def _parse_page(self, page):
+    @asyncio.coroutine
+    def _load_shared(self, url):
         """
-        parses the substitution HTML
+        loads the snapshot at url, joining a pending load if there is one
         """
-        soup = BeautifulSoup(page, "lxml")
+        pending = self._inflight.get(url)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load_snapshot(url),
+                                            loop=self.loop)
+            self._inflight[url] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(url, None))
+        else:
+            logger.debug("joining pending request for %s", url)
 
-        vertretung = soup.find(id="vertretung")
+        # shield, so one cancelled caller doesn't cancel the others
+        return (yield from asyncio.shield(pending, loop=self.loop))
 
-        if vertretung is None:
-            raise RequestError(
-                "no vertretung found. Check if site layout has changed, or an"
-                "error has occurred while getting page")
+    @asyncio.coroutine
+    def _load_snapshot(self, url):
+        """
+        downloads and parses the week at url and caches the result.
+
+        If the week was downloaded before, the request is made conditional
+        and the old parse is reused if the server reports it as not modified
+        or the page content is unchanged
+        """
+        old = self._snapshots.get(url)
+        if old is None and self.store is not None and url not in self._restored:
+            old = yield from self._restore(url)
+            if old is not None and url in self.cache:
+                return old
+
+        headers = {}
+        if old is not None:
+            if old.etag is not None:
+                headers["If-None-Match"] = old.etag
+            if old.last_modified is not None:
+                headers["If-Modified-Since"] = old.last_modified
+
+        try:
+            with metrics.timed(DOWNLOAD_TIME):
+                page = yield from self.fetch(url, headers)
+        except RequestError:
+            UNTIS_ERRORS.inc()
+            raise
+
+        changed = False
+        if page.status == 304 and old is not None:
+            logger.debug("%s not modified", url)
+            snapshot = old._replace(fetched=time.time())
+        else:
+            digest = hashlib.md5(page.text.encode("utf-8")).hexdigest()
+            if old is not None and old.digest == digest:
+                logger.debug("%s unchanged", url)
+                week = old.week
+            else:
+                with metrics.timed(PARSE_TIME):
+                    week = yield from self.parse(page.text)
+                changed = True
+            snapshot = Snapshot(week, digest, page.etag, page.last_modified,
+                                time.time())
+
+        self._snapshots[url] = snapshot
+        self.cache[url] = snapshot
+        self._persist(url, snapshot, changed)
+        return snapshot
+
+    @asyncio.coroutine
+    def parse(self, page):
+        """
+        parses a page, in the executor if there is one
+        """
+        if self.executor is None:
+            return parse_compact(self.parser, page, self.columnar)
+
+        # results of worker processes are pickled back to us, RecordTables
+        # are a lot smaller and faster to unpickle than lists of Records
+        columnar = self.columnar or isinstance(self.executor,
+                                               ProcessPoolExecutor)
+        return (yield from self.loop.run_in_executor(
+            self.executor, parse_compact, self.parser, page, columnar))
+
+    @asyncio.coroutine
+    def _restore(self, url):
+        """
+        loads the snapshot of url saved by an earlier run from the store. It
+        is cached for what is left of its ttl, and its validators are used to
+        revalidate it after that
+        """
+        self._restored.add(url)
+        try:
+            snapshot = yield from self.store.load(url)
+        except Exception:
+            logger.exception("could not load stored snapshot of %s", url)
+            return None
+        if snapshot is None:
+            return None
+
+        logger.debug("restored %s from the store", url)
+        self._snapshots[url] = snapshot
+        age = time.time() - snapshot.fetched
+        if age < self.cache.ttl:
+            self.cache.set(url, snapshot, ttl=self.cache.ttl - age)
+        return snapshot
+
+    def _persist(self, url, snapshot, changed=True):
+        """
+        saves snapshot to the store in the background. If the week didn't
+        change only its fetch time and validators are updated, pickling and
+        compressing the whole week again on every refresh would be wasted
+        """
+        if self.store is None:
+            return
+
+        def done(future):
+            if future.exception() is not None:
+                logger.error("could not store snapshot of %s: %r", url,
+                             future.exception())
+
+        write = self.store.save if changed else self.store.touch
+        asyncio.ensure_future(write(url, snapshot),
+                              loop=self.loop).add_done_callback(done)
+
+    def _next_schoolday(self, day):
+        """
+        gets the next schoolday after a date
+        """
+        pass
 
-        return vertretung
-    @MWT(timeout=60*15)
+    @asyncio.coroutine
     def _download(self, url):
         """
         Downloads the substitution table HTML at a certain URL
         """
-        try:
-            result = requests.get(url, auth=self.auth)
-        except OSError:
-            raise RequestError("Error getting VPlan")
+        page = yield from self.fetch(url)
+        return page.text
 
-        if result.status_code == 401:
-            raise RequestError("Invalid Authentication")
 
-        if result.status_code == 404:
-            raise RequestError("not found")
+def parse_page(page):
+    """
+    parses the substitution HTML
+    """
+    soup = BeautifulSoup(page, "lxml")
 
-        return result.text
+    vertretung = soup.find(id="vertretung")
 
+    if vertretung is None:
+        raise RequestError(
+            "no vertretung found. Check if site layout has changed, or an"
+            "error has occurred while getting page")
+
+    return vertretung
 
 def get_headings(table):
     return [th.text for th in table.find_all("th")]
@@ -163,10 +423,22 @@ def subst_available(table):
 
 
 class DayInfo:
-    weekday = 0
-    headers = []
-    data = []
-    info = []
+    __slots__ = ("weekday", "headers", "data", "info", "index")
+
+    def __init__(self, weekday=0, headers=None, data=None, info=None):
+        self.weekday = weekday
+        self.headers = headers if headers is not None else []
+        self.data = data if data is not None else []
+        self.info = info if info is not None else []
+        self.index = None # subscriptions.SubstIndex of data, built on demand
+
+    def __getstate__(self):
+        # the index is rebuilt on demand, don't store it
+        return (self.weekday, self.headers, self.data, self.info)
+
+    def __setstate__(self, state):
+        self.weekday, self.headers, self.data, self.info = state
+        self.index = None
 
     def __str__(self):
         return "DayInfo for weekday {}".format(self.weekday)
@@ -174,10 +446,40 @@ class DayInfo:
     def __repr__(self):
         return "{} object at {}".format(self.__str__(), str(id(self)))
 
+def find_day(week, weekday) -> DayInfo:
+    """
+    returns the day of week whose anchor names weekday (0 for Monday, like
+    date.weekday). Pages may leave out days, so the position in the week
+    can't be used. A LazyWeek is only parsed up to that day
+    """
+    for day in week:
+        if day.weekday == weekday + 1:
+            return day
+        if day.weekday > weekday + 1:
+            break # the days are in order
+    raise NoSubstError("No substitution for this day")
+
+def week_size(week):
+    """
+    approximate size of a parsed week, used to bound the cache
+    """
+    if isinstance(week, LazyWeek):
+        # don't force parsing the rest of the week just to measure it
+        return week.size()
+
+    size = 0
+    for day in week:
+        for row in day.data:
+            size += sum(len(i) for i in row)
+        for row in day.info:
+            size += sum(len(i) for i in row)
+    return size
+
 def clean(s):
     s = s.replace("\x0B", "")
     s = s.replace("\xa0", "")
-    return s
+    # most cells repeat ("---", rooms, grades), keep one copy of each
+    return sys.intern(s)
 
 def parse_info(info):
     rows = info.find_all("tr")
@@ -238,3 +540,368 @@ def find(subst):
         raise RequestError("No 5 days of week")
 
     return days
+
+
+def parse_week(page):
+    """
+    parses a week page with BeautifulSoup and returns its DayInfo objects
+    """
+    return find(parse_page(page))
+
+
+# lxml backend. Works on the lxml.etree tree directly instead of building a
+# BeautifulSoup tree first, but returns the same DayInfo objects
+
+
+def parse_page_lxml(page):
+    """
+    parses the substitution HTML into an lxml element tree
+    """
+    root = lxml.html.fromstring(page)
+
+    vertretung = root.find(".//*[@id='vertretung']")
+
+    if vertretung is None:
+        raise RequestError(
+            "no vertretung found. Check if site layout has changed, or an"
+            "error has occurred while getting page")
+
+    return vertretung
+
+
+def get_headings_lxml(table):
+    return [th.text_content() for th in table.iter("th")]
+
+
+def is_subst_lxml(table):
+    return table.get("class", "").split() == ["subst"]
+
+
+def parse_info_lxml(info):
+    return [
+        [clean(elem.text_content()) for elem in row.iter("td")]
+        for row in info.iter("tr")]
+
+
+def parse_subst_lxml(subst):
+    res = []
+    for tr in subst.iter("tr"):
+        row = list(tr.iter("td"))[:9]
+        if len(row) > 1:
+            res.append(Record(*[clean(elem.text_content()) for elem in row]))
+
+    return res
+
+
+def find_lxml(subst):
+    # like BeautifulSoup's find_next, the next table is searched in the whole
+    # document and not only in the #vertretung subtree
+    ordered = subst.getroottree().getroot().iter("a", "table")
+    position = {}
+    tables = []
+    for i, elem in enumerate(ordered):
+        position[elem] = i
+        if elem.tag == "table":
+            tables.append(i)
+    elements = {i: elem for elem, i in position.items()}
+
+    def find_next_table(elem):
+        i = bisect.bisect_right(tables, position[elem])
+        return elements[tables[i]] if i < len(tables) else None
+
+    days = []
+
+    for link in subst.iter("a"):
+        if link.get("name") is None:
+            continue
+
+        day = DayInfo()
+
+        day.weekday = int(link.get("name"))
+        next_table = find_next_table(link)
+
+        if next_table is not None and len(get_headings_lxml(next_table)) == 1:
+            day.info = parse_info_lxml(next_table)
+            subst_table = find_next_table(next_table)
+        else:
+            subst_table = next_table
+
+        if subst_table is None:
+            logger.warning("RECOVERABLE TABLE ERROR")
+            days.append(day)
+            continue
+
+        if is_subst_lxml(subst_table):
+            day.headers = get_headings_lxml(subst_table)
+            day.data = parse_subst_lxml(subst_table)
+
+        days.append(day)
+
+    if len(days) != 5:
+        raise RequestError("No 5 days of week")
+
+    return days
+
+
+def parse_week_lxml(page):
+    """
+    parses a week page with lxml and returns its DayInfo objects
+    """
+    return find_lxml(parse_page_lxml(page))
+
+
+# streaming backend. Parses the page incrementally, so a request for one
+# day stops once that day is complete, and a partial week gives the days it
+# has instead of failing
+
+
+# <meta> tags declaring a charset, e.g. the iso-8859-1 of UNTIS pages
+META_CHARSET = re.compile(r"<meta[^>]*charset[^>]*>", re.IGNORECASE)
+
+
+def iter_days(page, chunk_size=16*1024):
+    """
+    parses a week page chunk by chunk and yields each DayInfo as soon as
+    its tables have been read
+    """
+    # page is already decoded, but libxml2 would switch to the declared
+    # charset while being fed and garble umlauts after the first chunk
+    page = META_CHARSET.sub("", page)
+    parser = lxml.etree.HTMLPullParser(events=("start", "end"))
+    # HtmlElement for text_content(), used by the *_lxml helpers
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+
+    container = None
+    found_container = False
+    table_depth = 0
+    day = None
+    state = None # which table the current day expects: "first", "subst"
+
+    def events(final=False):
+        if final:
+            parser.close()
+        return parser.read_events()
+
+    chunks = (page[i:i + chunk_size] for i in range(0, len(page), chunk_size))
+    done = False
+    while not done:
+        chunk = next(chunks, None)
+        if chunk is None:
+            pending = events(final=True)
+            done = True
+        else:
+            parser.feed(chunk)
+            pending = events()
+
+        for event, elem in pending:
+            if event == "start":
+                if container is None:
+                    if elem.get("id") == "vertretung" and not found_container:
+                        container = elem
+                        found_container = True
+                elif elem.tag == "a" and elem.get("name") is not None:
+                    if day is not None and state is not None:
+                        yield day
+                    day = DayInfo()
+                    day.weekday = int(elem.get("name"))
+                    state = "first"
+                elif elem.tag == "table":
+                    table_depth += 1
+                continue
+
+            # end events
+            if elem is container:
+                container = None
+                continue
+
+            if container is None or elem.tag != "table":
+                continue
+
+            table_depth -= 1
+            if table_depth or state is None:
+                continue
+
+            if state == "first" and len(get_headings_lxml(elem)) == 1:
+                day.info = parse_info_lxml(elem)
+                state = "subst"
+            else:
+                if is_subst_lxml(elem):
+                    day.headers = get_headings_lxml(elem)
+                    day.data = parse_subst_lxml(elem)
+                state = None
+                yield day
+            elem.clear()
+
+    if not found_container:
+        raise RequestError(
+            "no vertretung found. Check if site layout has changed, or an"
+            "error has occurred while getting page")
+
+    if day is not None and state is not None:
+        yield day
+
+
+class LazyWeek:
+    """
+    Sequence of the days of a week page that is only parsed as far as the
+    days that have been asked for
+    """
+    def __init__(self, page):
+        self.page = page
+        self._page_size = len(page)
+        self._days = []
+        self._iter = iter_days(page)
+        self.columnar = False # store days parsed from now on as RecordTables
+
+    def _parse_until(self, index):
+        while len(self._days) <= index and self._iter is not None:
+            try:
+                day = next(self._iter)
+                if self.columnar:
+                    compact_day(day)
+                self._days.append(day)
+            except StopIteration:
+                # the page isn't needed anymore once everything is parsed
+                self._iter = None
+                self.page = None
+
+    def __getitem__(self, index):
+        self._parse_until(index if index >= 0 else sys.maxsize)
+        return self._days[index]
+
+    def __len__(self):
+        self._parse_until(sys.maxsize)
+        return len(self._days)
+
+    def __iter__(self):
+        i = 0
+        while True:
+            try:
+                yield self[i]
+            except IndexError:
+                return
+            i += 1
+
+    def size(self):
+        return self._page_size
+
+    def __reduce__(self):
+        # the parser can't be pickled, store the page to parse again instead
+        page = self.page
+        if page is None:
+            return (list, (list(self._days),))
+        return (restore_lazy_week, (page, self.columnar))
+
+
+def restore_lazy_week(page, columnar):
+    week = LazyWeek(page)
+    week.columnar = columnar
+    return week
+
+
+def parse_week_lazy(page):
+    """
+    returns a LazyWeek of the page. Only the first day is parsed right away,
+    to report pages without substitutions early
+    """
+    week = LazyWeek(page)
+    week._parse_until(0)
+    return week
+
+
+class RecordTable:
+    """
+    Substitution rows stored by column. Every column is an array of indices
+    into one list of the distinct strings of the table, which is much
+    smaller than a list of Records and lets filters scan a column without
+    creating the rows. Behaves like a read-only list of Records
+    """
+    __slots__ = ("strings", "columns", "_length")
+
+    def __init__(self, rows=()):
+        self.strings = []
+        self.columns = [array.array("I") for _ in Record._fields]
+        codes = {}
+        length = 0
+        for row in rows:
+            for column, value in zip(self.columns, row):
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(self.strings)
+                    self.strings.append(value)
+                column.append(code)
+            length += 1
+        self._length = length
+
+    def column(self, name):
+        """
+        the codes of the field name of Record, index into strings
+        """
+        return self.columns[Record._fields.index(name)]
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("RecordTable index out of range")
+        strings = self.strings
+        return Record(*[strings[column[index]] for column in self.columns])
+
+    def __iter__(self):
+        strings = self.strings
+        for codes in zip(*self.columns):
+            yield Record(*[strings[code] for code in codes])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "RecordTable({!r})".format(list(self))
+
+
+def compact_day(day):
+    """
+    converts the rows of a DayInfo to a RecordTable
+    """
+    if not isinstance(day.data, RecordTable):
+        day.data = RecordTable(day.data)
+        day.index = None
+    return day
+
+
+def compact_week(week):
+    """
+    converts the rows of every day of week to RecordTables. Days of a
+    LazyWeek are converted as they get parsed
+    """
+    if isinstance(week, LazyWeek):
+        week.columnar = True
+        days = week._days
+    else:
+        days = week
+    for day in days:
+        compact_day(day)
+    return week
+
+
+def parse_compact(parser, page, columnar=False):
+    """
+    parses page with parser and converts the rows to RecordTables if
+    columnar. Runs in executor workers, so it must be picklable
+    """
+    week = parser(page)
+    if columnar:
+        compact_week(week)
+    return week
+
+
+PARSERS = {
+    "bs4": parse_week,
+    "lxml": parse_week_lxml,
+    "lazy": parse_week_lazy,
+}
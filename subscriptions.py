@@ -0,0 +1,117 @@
+"""
+Matches substitutions against the grades, courses and teachers users have
+subscribed to
+"""
+from collections import defaultdict
+
+KINDS = ("grade", "lesson", "teacher")
+
+
+def normalize(value):
+    return value.strip().lower()
+
+
+def row_keys(row):
+    """
+    returns the (kind, value) pairs a SubstRecord can be found by
+    """
+    keys = set()
+    for grade in row.grade.split(","):
+        keys.add(("grade", normalize(grade)))
+    for lesson in (row.lesson, row.orig_lesson):
+        keys.add(("lesson", normalize(lesson)))
+    for teacher in (row.teacher, row.orig_teacher):
+        keys.add(("teacher", normalize(teacher)))
+    return keys
+
+
+def matches(row, subscriptions):
+    """
+    whether a single SubstRecord matches any of the subscriptions
+    """
+    return not row_keys(row).isdisjoint(subscriptions)
+
+
+class SubstIndex:
+    """
+    Rows of a day indexed by grade, lesson and teacher, so the rows for a
+    set of subscriptions can be looked up instead of checking every row
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.index = defaultdict(list)
+        for i, row in enumerate(rows):
+            for key in row_keys(row):
+                self.index[key].append(i)
+
+    def lookup(self, subscriptions) -> list:
+        """
+        returns the rows matching any of the subscriptions, in their
+        original order
+        """
+        found = set()
+        for key in subscriptions:
+            found.update(self.index.get(key, ()))
+        return [self.rows[i] for i in sorted(found)]
+
+
+# columns of a reader.RecordTable searched for each kind, like row_keys
+KIND_COLUMNS = {
+    "grade": ("grade",),
+    "lesson": ("lesson", "orig_lesson"),
+    "teacher": ("teacher", "orig_teacher"),
+}
+
+
+class ColumnIndex:
+    """
+    Looks up subscriptions in a reader.RecordTable by scanning its columns
+    of string codes. Only the distinct strings of the table are normalized
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def _codes(self, kind, values):
+        """
+        codes of the strings of the table that match one of values
+        """
+        codes = set()
+        for code, string in enumerate(self.rows.strings):
+            if kind == "grade":
+                keys = [normalize(grade) for grade in string.split(",")]
+            else:
+                keys = [normalize(string)]
+            if not values.isdisjoint(keys):
+                codes.add(code)
+        return codes
+
+    def lookup(self, subscriptions) -> list:
+        """
+        returns the rows matching any of the subscriptions, in their
+        original order
+        """
+        hits = bytearray(len(self.rows))
+        for kind, columns in KIND_COLUMNS.items():
+            values = {value for k, value in subscriptions if k == kind}
+            if not values:
+                continue
+            codes = self._codes(kind, values)
+            for name in columns:
+                for i, code in enumerate(self.rows.column(name)):
+                    if code in codes:
+                        hits[i] = 1
+        return [self.rows[i] for i, hit in enumerate(hits) if hit]
+
+
+def index_for(day):
+    """
+    returns the SubstIndex of a DayInfo, building it on first use. Rows
+    stored as a reader.RecordTable get a ColumnIndex instead
+    """
+    index = day.index
+    if index is None or index.rows is not day.data:
+        if hasattr(day.data, "column"):
+            index = day.index = ColumnIndex(day.data)
+        else:
+            index = day.index = SubstIndex(day.data)
+    return index
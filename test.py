@@ -1,10 +1,20 @@
 import unittest
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import broadcast
+import cache
+import metrics
+import plans
+import ratelimit
 import reader
+import subscriptions
 import main
+import telepot
 from datetime import date, datetime, timedelta
 import sqlite3
 import database
 import os
+import time
 
 CONFIG = {}
 
@@ -16,24 +26,481 @@ with open("../keyfile", "r") as f:
 
 class ReaderTest(unittest.TestCase):
     def setUp(self):
+        self.loop = asyncio.get_event_loop()
         self.reader = reader.Reader(CONFIG["url"], (CONFIG["user"], CONFIG["pass"]))
 
+    def tearDown(self):
+        self.reader.close()
+
     def test_simple_download(self):
         url = self.reader.url.format(weeknum=1)
-        self.reader._download(url)
+        self.loop.run_until_complete(self.reader._download(url))
 
     def test_get_day(self):
         d = date(day=9, month=12, year=2016)
-        day = self.reader.get_day(d)
+        day = self.loop.run_until_complete(self.reader.get_day(d))
 
     @unittest.skipIf(datetime.today().weekday() > 4,
             "skipping today on weekends")
     def test_get_today(self):
         d = date.today()
-        day = self.reader.get_day(d)
+        day = self.loop.run_until_complete(self.reader.get_day(d))
         assert len(day.data) > 1
 
 
+class CoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.reader = reader.Reader("http://localhost/{weeknum:02}", ("u", "p"))
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+
+        @asyncio.coroutine
+        def fake_load_snapshot(url):
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            yield from asyncio.sleep(0.01)
+            self.active -= 1
+            week = [reader.DayInfo(weekday=i + 1) for i in range(5)]
+            snapshot = reader.Snapshot(week, "", None, None, 0)
+            self.reader.cache[url] = snapshot
+            return snapshot
+
+        self.reader._load_snapshot = fake_load_snapshot
+
+    def test_concurrent_requests_share_download(self):
+        requests = [self.reader.get_week(10) for _ in range(20)]
+        weeks = self.loop.run_until_complete(asyncio.gather(*requests))
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(w is weeks[0] for w in weeks))
+
+    def test_different_weeks_not_shared(self):
+        requests = [self.reader.get_week(10), self.reader.get_week(11)]
+        self.loop.run_until_complete(asyncio.gather(*requests))
+        self.assertEqual(self.calls, 2)
+
+    def test_cached_week_not_reloaded(self):
+        self.loop.run_until_complete(self.reader.get_week(10))
+        day = self.loop.run_until_complete(
+            self.reader.get_day(date(2016, 3, 7)))
+        self.assertEqual(self.calls, 1)
+        week = self.loop.run_until_complete(self.reader.get_week(10))
+        self.assertIs(week[0], day)
+
+    def test_get_range_loads_weeks_concurrently(self):
+        # friday of week 10 to tuesday of week 11
+        days = self.loop.run_until_complete(
+            self.reader.get_range(date(2016, 3, 11), date(2016, 3, 15)))
+        self.assertEqual([day.weekday for day in days], [5, 1, 2])
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.max_active, 2)
+
+    def test_get_range_skips_missing_week(self):
+        get_week = self.reader.get_week
+
+        @asyncio.coroutine
+        def fake_get_week(weeknum):
+            if weeknum == 11:
+                raise reader.RequestError("not found")
+            return (yield from get_week(weeknum))
+
+        self.reader.get_week = fake_get_week
+        days = self.loop.run_until_complete(
+            self.reader.get_range(date(2016, 3, 10), date(2016, 3, 15)))
+        self.assertEqual([day.weekday for day in days], [4, 5])
+        with self.assertRaises(reader.RequestError):
+            self.loop.run_until_complete(
+                self.reader.get_range(date(2016, 3, 14), date(2016, 3, 15)))
+
+    def test_refresh_bypasses_cache(self):
+        self.loop.run_until_complete(self.reader.get_week(10))
+        self.loop.run_until_complete(self.reader.refresh(10))
+        self.assertEqual(self.calls, 2)
+
+
+SUBST_ROW = ("<tr><td>{period}</td><td>Q34</td><td>Mu</td><td>pw76</td>"
+             "<td>D107</td><td>&nbsp;</td><td>Ab</td><td>pw76</td>"
+             "<td>D108</td></tr>")
+
+def make_page(days=5, rows=3, first=1):
+    parts = ['<html><body><div id="vertretung">']
+    for day in range(first, days + 1):
+        parts.append('<a name="{}">Tag {}</a>'.format(day, day))
+        if day % 2:
+            parts.append('<table><tr><th>Nachrichten zum Tag</th></tr>'
+                         '<tr><td>Aula gesperrt</td></tr></table>')
+        parts.append('<table class="subst"><tr><th>Stunde</th><th>Klasse</th>'
+                     '<th>Vertreter</th></tr>')
+        parts.extend(SUBST_ROW.format(period=i) for i in range(rows))
+        parts.append('</table>')
+    parts.append('</div></body></html>')
+    return "".join(parts)
+
+
+class ParserTest(unittest.TestCase):
+    def assertSameWeek(self, week_a, week_b):
+        self.assertEqual(len(week_a), len(week_b))
+        for day_a, day_b in zip(week_a, week_b):
+            self.assertEqual(day_a.weekday, day_b.weekday)
+            self.assertEqual(day_a.headers, day_b.headers)
+            self.assertEqual(day_a.data, day_b.data)
+            self.assertEqual(day_a.info, day_b.info)
+
+    def test_backends_agree(self):
+        page = make_page()
+        weeks = [parse(page) for parse in reader.PARSERS.values()]
+        for week in weeks[1:]:
+            self.assertSameWeek(weeks[0], week)
+
+    def test_parse(self):
+        for parse in reader.PARSERS.values():
+            week = parse(make_page(rows=2))
+            self.assertEqual(week[0].info, [[], ["Aula gesperrt"]])
+            self.assertEqual(week[1].info, [])
+            self.assertEqual(week[0].data[1].period, "1")
+            self.assertEqual(week[0].data[1].orig_room, "D108")
+
+    def test_missing_vertretung(self):
+        for parse in reader.PARSERS.values():
+            with self.assertRaises(reader.RequestError):
+                parse("<html><body></body></html>")
+
+    def test_wrong_day_count(self):
+        for parse in (reader.parse_week, reader.parse_week_lxml):
+            with self.assertRaises(reader.RequestError):
+                parse(make_page(days=4))
+
+    def test_lazy_partial_week(self):
+        week = reader.parse_week_lazy(make_page(days=4))
+        self.assertEqual([day.weekday for day in week], [1, 2, 3, 4])
+
+    def test_lazy_parses_on_demand(self):
+        week = reader.parse_week_lazy(make_page())
+        self.assertEqual(week[1].weekday, 2)
+        self.assertEqual(len(week._days), 2)
+        self.assertEqual(len(week), 5)
+        self.assertIsNone(week.page)
+
+    def test_find_day_by_anchor(self):
+        week = reader.parse_week_lazy(make_page(first=2))
+        self.assertEqual(reader.find_day(week, 1).weekday, 2)
+        self.assertEqual(len(week._days), 1)
+        self.assertEqual(reader.find_day(week, 4).weekday, 5)
+        with self.assertRaises(reader.NoSubstError):
+            reader.find_day(week, 0)
+        with self.assertRaises(reader.NoSubstError):
+            reader.find_day(reader.parse_week_lxml(make_page()), 5)
+
+    def test_lazy_ignores_meta_charset(self):
+        # UNTIS declares iso-8859-1, but the page is already decoded
+        page = make_page().replace(
+            "<html>", '<html><head><meta http-equiv="Content-Type" '
+            'content="text/html; charset=iso-8859-1"></head>').replace(
+                "Aula gesperrt", "Aula gesperrt, Schüler bitte in Raum Ä1")
+        self.assertGreater(page.index("ü"), 64)
+        lazy = [day for day in reader.iter_days(page, chunk_size=64)]
+        self.assertSameWeek(lazy, reader.parse_week_lxml(page))
+        self.assertEqual(lazy[0].info[1],
+                         ["Aula gesperrt, Schüler bitte in Raum Ä1"])
+
+
+class ConditionalGetTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.reader = reader.Reader("http://localhost/{weeknum:02}", ("u", "p"),
+                                    cache_ttl=0)
+        self.parses = 0
+        self.requests = []
+        self.responses = []
+
+        @asyncio.coroutine
+        def fake_fetch(url, headers=None):
+            self.requests.append(headers)
+            return self.responses.pop(0)
+
+        def counting_parser(page):
+            self.parses += 1
+            return reader.parse_week(page)
+
+        self.reader.fetch = fake_fetch
+        self.reader.parser = counting_parser
+
+    def get_week(self):
+        return self.loop.run_until_complete(self.reader.get_week(10))
+
+    def test_not_modified(self):
+        self.responses = [reader.Page(200, make_page(), '"a"', None),
+                          reader.Page(304, None, '"a"', None)]
+        first = self.get_week()
+        second = self.get_week()
+        self.assertIs(first, second)
+        self.assertEqual(self.parses, 1)
+        self.assertEqual(self.requests[1], {"If-None-Match": '"a"'})
+
+    def test_unchanged_body_not_parsed(self):
+        self.responses = [reader.Page(200, make_page(), None, "yesterday"),
+                          reader.Page(200, make_page(), None, "yesterday")]
+        self.get_week()
+        self.get_week()
+        self.assertEqual(self.parses, 1)
+        self.assertEqual(self.requests[1], {"If-Modified-Since": "yesterday"})
+
+    def test_changed_body_parsed(self):
+        self.responses = [reader.Page(200, make_page(rows=1), None, None),
+                          reader.Page(200, make_page(rows=2), None, None)]
+        self.get_week()
+        week = self.get_week()
+        self.assertEqual(self.parses, 2)
+        self.assertEqual(len(week[0].data), 2)
+
+
+class ExecutorParseTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def parse_with(self, executor, parser="lxml"):
+        vplan = reader.Reader("http://localhost/{weeknum:02}", ("u", "p"),
+                              parser=parser, executor=executor)
+        try:
+            return self.loop.run_until_complete(vplan.parse(make_page()))
+        finally:
+            executor.shutdown()
+
+    def test_thread_pool(self):
+        week = self.parse_with(ThreadPoolExecutor(1))
+        self.assertEqual(week[0].data, reader.parse_week(make_page())[0].data)
+
+    def test_process_pool_returns_record_tables(self):
+        week = self.parse_with(ProcessPoolExecutor(1))
+        self.assertIsInstance(week[0].data, reader.RecordTable)
+        self.assertEqual(list(week[0].data),
+                         reader.parse_week(make_page())[0].data)
+
+    def test_lazy_not_used_in_executor(self):
+        week = self.parse_with(ThreadPoolExecutor(1), parser="lazy")
+        self.assertIsInstance(week, list)
+
+
+class SnapshotRestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.stored = {}
+        self.saves = 0
+        self.responses = []
+        self.requests = []
+
+        test = self
+        class FakeStore:
+            @asyncio.coroutine
+            def load(self, url):
+                return test.stored.get(url)
+
+            @asyncio.coroutine
+            def save(self, url, snapshot):
+                test.saves += 1
+                test.stored[url] = snapshot
+
+            @asyncio.coroutine
+            def touch(self, url, snapshot):
+                test.stored[url] = test.stored[url]._replace(
+                    fetched=snapshot.fetched, etag=snapshot.etag,
+                    last_modified=snapshot.last_modified)
+
+        @asyncio.coroutine
+        def fake_fetch(url, headers=None):
+            self.requests.append(headers)
+            return self.responses.pop(0)
+
+        self.reader = reader.Reader("http://localhost/{weeknum:02}", ("u", "p"),
+                                    store=FakeStore())
+        self.reader.fetch = fake_fetch
+        self.url = self.reader.url.format(weeknum=10)
+        self.week = reader.parse_week(make_page())
+
+    def get_week(self):
+        return self.loop.run_until_complete(self.reader.get_week(10))
+
+    def test_fresh_snapshot_served_without_request(self):
+        self.stored[self.url] = reader.Snapshot(self.week, "", None, None,
+                                                time.time())
+        self.assertIs(self.get_week(), self.week)
+        self.assertEqual(self.requests, [])
+
+    def test_old_snapshot_revalidated(self):
+        self.stored[self.url] = reader.Snapshot(self.week, "", '"a"', None, 0)
+        self.responses = [reader.Page(304, None, '"a"', None)]
+        self.assertIs(self.get_week(), self.week)
+        self.assertEqual(self.requests, [{"If-None-Match": '"a"'}])
+
+    def test_new_snapshot_saved(self):
+        self.responses = [reader.Page(200, make_page(), '"b"', None)]
+        week = self.get_week()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertIs(self.stored[self.url].week, week)
+        self.assertEqual(self.stored[self.url].etag, '"b"')
+
+    def test_unchanged_snapshot_only_touched(self):
+        self.stored[self.url] = reader.Snapshot(self.week, "", '"a"', None, 0)
+        self.responses = [reader.Page(304, None, '"a"', None)]
+        self.get_week()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.saves, 0)
+        self.assertGreater(self.stored[self.url].fetched, 0)
+
+
+class SubscriptionTest(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            reader.Record("1", "Q34", "Mu", "pw76", "D107", "", "Ab", "pw76", "D108"),
+            reader.Record("2", "5a, 5b", "Ke", "m1", "A1", "", "Ke", "m1", "A2"),
+            reader.Record("3", "Q12", "Ab", "d3", "B1", "", "Zi", "d3", "B1"),
+        ]
+        self.index = subscriptions.SubstIndex(self.rows)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup({("grade", "5b")}), [self.rows[1]])
+        self.assertEqual(self.index.lookup({("teacher", "ab")}),
+                         [self.rows[0], self.rows[2]])
+        self.assertEqual(self.index.lookup(
+            {("lesson", "d3"), ("grade", "q34")}), [self.rows[0], self.rows[2]])
+        self.assertEqual(self.index.lookup({("grade", "7c")}), [])
+
+    def test_matches(self):
+        self.assertTrue(subscriptions.matches(self.rows[0], {("teacher", "mu")}))
+        self.assertFalse(subscriptions.matches(self.rows[1], {("teacher", "mu")}))
+
+    def test_index_for_rebuilds_on_new_data(self):
+        day = reader.DayInfo()
+        day.data = self.rows
+        index = subscriptions.index_for(day)
+        self.assertIs(subscriptions.index_for(day), index)
+        day.data = self.rows[:1]
+        self.assertIsNot(subscriptions.index_for(day), index)
+
+    def test_column_index(self):
+        day = reader.compact_day(reader.DayInfo(data=self.rows))
+        index = subscriptions.index_for(day)
+        self.assertIsInstance(index, subscriptions.ColumnIndex)
+        for subs in [{("grade", "5b")}, {("teacher", "ab")}, {("grade", "7c")},
+                     {("lesson", "d3"), ("grade", "q34")}]:
+            self.assertEqual(index.lookup(subs), self.index.lookup(subs))
+
+
+class RecordTableTest(unittest.TestCase):
+    def test_rows(self):
+        rows = reader.parse_week_lxml(make_page(rows=3))[0].data
+        table = reader.RecordTable(rows)
+        self.assertEqual(len(table), len(rows))
+        self.assertEqual(list(table), rows)
+        self.assertEqual(table[-1], rows[-1])
+        self.assertEqual(table[1:], rows[1:])
+        self.assertEqual(len(table.strings), len(set().union(*rows)))
+        with self.assertRaises(IndexError):
+            table[len(rows)]
+
+    def test_columnar_week(self):
+        page = make_page()
+        for parse in reader.PARSERS.values():
+            week = reader.compact_week(parse(page))
+            for day in week:
+                self.assertIsInstance(day.data, reader.RecordTable)
+            self.assertEqual(list(week[0].data), reader.parse_week(page)[0].data)
+
+
+class TTLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = cache.TTLCache(10, maxsize=3, maxbytes=10, sizeof=len,
+                                    clock=lambda: self.now)
+
+    def test_hit_and_miss(self):
+        self.cache["a"] = "x"
+        self.assertEqual(self.cache["a"], "x")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_expiry(self):
+        self.cache["a"] = "x"
+        self.now = 11
+        self.assertNotIn("a", self.cache)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.expirations, 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        for key in "abc":
+            self.cache[key] = key
+        self.cache.get("a")
+        self.cache["d"] = "d"
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_byte_limit(self):
+        self.cache["a"] = "xxxxxx"
+        self.cache["b"] = "yyyyyy"
+        self.assertNotIn("a", self.cache)
+        self.assertEqual(self.cache.nbytes, 6)
+        self.cache["c"] = "z" * 11
+        self.assertNotIn("c", self.cache)
+
+
+class RenderCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.digest = "a"
+        self.formatted = 0
+        test = self
+
+        class FakeReader:
+            @asyncio.coroutine
+            def get_snapshot(self, weeknum):
+                week = reader.parse_week(make_page())
+                return reader.Snapshot(week, test.digest, None, None, 0)
+
+        class Bot:
+            readers = plans.ReaderPool({plans.DEFAULT: FakeReader()})
+            render_cache = cache.TTLCache(60, sizeof=len)
+            render_day = main.VPlanBot.render_day
+
+        self.bot = Bot()
+        self.day = date(2016, 12, 5)
+        self.format_subst = main.format_subst
+
+        def counting_format_subst(*args):
+            self.formatted += 1
+            return self.format_subst(*args)
+
+        main.format_subst = counting_format_subst
+
+    def tearDown(self):
+        main.format_subst = self.format_subst
+
+    def render(self, subs=frozenset()):
+        return self.loop.run_until_complete(self.bot.render_day(self.day, subs))
+
+    def test_repeat_request_hits_cache(self):
+        first = self.render()
+        self.assertIs(self.render(), first)
+        self.assertEqual(self.formatted, 1)
+        self.assertEqual(self.bot.render_cache.hits, 1)
+
+    def test_new_digest_misses(self):
+        self.render()
+        self.digest = "b"
+        self.render()
+        self.assertEqual(self.formatted, 2)
+
+    def test_subscriptions_are_part_of_key(self):
+        self.render()
+        self.render(frozenset({("teacher", "mu")}))
+        self.assertEqual(self.formatted, 2)
+        self.assertEqual(len(self.bot.render_cache), 2)
+
+
 class SubstManagerTest(unittest.TestCase):
     def setUp(self):
         self.connection = sqlite3.connect(":memory:")
@@ -85,6 +552,28 @@ class SubstManagerTest(unittest.TestCase):
                 subst, date.today())
         self.assertTrue(ret)
 
+    def test_register_new_bulk(self):
+        today = date.today()
+        tomorrow = today + timedelta(days=1)
+        self.subst_manager.check_new_and_register(["a"], today)
+
+        new = self.subst_manager.register_new(
+            [(["a"], today), (["b"], today), (["a"], tomorrow), (["b"], today)])
+        self.assertEqual(new, [(["b"], today), (["a"], tomorrow)])
+        self.assertEqual(self.subst_manager.register_new([(["b"], today)]), [])
+
+    def test_plans_registered_separately(self):
+        today = date.today()
+        self.assertTrue(self.subst_manager.check_new_and_register(["a"], today))
+        self.assertTrue(self.subst_manager.check_new_and_register(
+            ["a"], today, "lehrer"))
+        self.assertFalse(self.subst_manager.check_new_and_register(
+            ["a"], today, "lehrer"))
+
+        self.subst_manager.mark_initialized()
+        self.assertTrue(self.subst_manager.is_initialized())
+        self.assertFalse(self.subst_manager.is_initialized("lehrer"))
+
 class UserManagerTest(unittest.TestCase):
     def setUp(self):
         self.connection = sqlite3.connect(":memory:")
@@ -98,6 +587,18 @@ class UserManagerTest(unittest.TestCase):
         self.users.create_user(11111119241265)
         self.assertFalse(self.users.is_user(222222219241265))
 
+    def test_plans(self):
+        self.users.create_user(1)
+        self.users.create_user(2)
+        self.assertIsNone(self.users.get_plan(1))
+        self.users.set_plan(1, "lehrer")
+        self.assertEqual(self.users.get_plan(1), "lehrer")
+        # plans are loaded again on startup
+        self.assertEqual(database.UserManager(self.connection).get_plans(),
+                         {1: "lehrer"})
+        self.users.set_plan(1, None)
+        self.assertEqual(self.users.get_plans(), {})
+
     def test_broadcast_query(self):
         self.users.create_user(10)
         self.assertEqual(len(self.users.get_broadcasters()), 0)
@@ -106,6 +607,509 @@ class UserManagerTest(unittest.TestCase):
         self.assertEqual(len(self.users.get_broadcasters()), 1)
         self.assertIn(10, self.users.get_broadcasters())
 
+    def test_batched_creation(self):
+        users = database.UserManager(self.connection, batch_size=3,
+                                     max_delay=60)
+        self.assertTrue(users.ensure_user(1))
+        self.assertFalse(users.ensure_user(1))
+        users.ensure_user(2)
+        self.assertTrue(users.is_user(2))
+        self.assertEqual(self.connection.execute(
+            "SELECT COUNT(*) FROM users").fetchone()[0], 0)
+        users.ensure_user(3)
+        self.assertEqual(self.connection.execute(
+            "SELECT COUNT(*) FROM users").fetchone()[0], 3)
+
+    def test_known_users_loaded(self):
+        self.users.create_user(5)
+        users = database.UserManager(self.connection)
+        self.assertTrue(users.is_user(5))
+
+class MigrationTest(unittest.TestCase):
+    def test_migrate_old_database(self):
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE TABLE users(id INTEGER PRIMARY KEY, "
+                           "recieve_broadcast BOOLEAN);")
+        connection.execute("INSERT INTO users VALUES (1, NULL)")
+        users = database.UserManager(connection)
+        self.assertEqual(connection.execute("PRAGMA user_version").fetchone()[0],
+                         database.SCHEMA_VERSION)
+        self.assertEqual(connection.execute(
+            "SELECT recieve_broadcast FROM users").fetchone()[0], 0)
+        users.create_user(2)
+        database.migrate(connection)
+        self.assertEqual(len(users.get_all_users()), 2)
+
+
+class SnapshotManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshots = database.SnapshotManager(sqlite3.connect(":memory:"))
+
+    def test_roundtrip(self):
+        for parse in reader.PARSERS.values():
+            week = reader.compact_week(parse(make_page()))
+            self.snapshots.save("a", reader.Snapshot(week, "d", '"e"', None, 5))
+            snapshot = self.snapshots.load("a")
+            self.assertEqual(snapshot.etag, '"e"')
+            self.assertEqual(snapshot.fetched, 5)
+            self.assertEqual(list(snapshot.week[2].data), list(week[2].data))
+        self.assertIsNone(self.snapshots.load("b"))
+
+    def test_touch(self):
+        self.snapshots.save("a", reader.Snapshot([], "d", '"e"', None, 5))
+        self.snapshots.touch("a", reader.Snapshot(None, "d", '"f"', "x", 7))
+        snapshot = self.snapshots.load("a")
+        self.assertEqual((snapshot.week, snapshot.etag, snapshot.last_modified,
+                          snapshot.fetched), ([], '"f"', "x", 7))
+
+    def test_prune(self):
+        self.snapshots.save("a", reader.Snapshot([], "", None, None, 5))
+        self.snapshots.prune_older_than(10)
+        self.assertIsNone(self.snapshots.load("a"))
+
+
+class ArchiveManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.archive = database.ArchiveManager(sqlite3.connect(":memory:"))
+        self.monday = date(2016, 12, 5)
+        self.year = (date(2016, 8, 1), date(2017, 7, 31))
+        self.rows = [
+            reader.Record("1", "Q34", "Mu", "pw76", "D107", "", "Ab", "pw76", "D108"),
+            reader.Record("2", "5a, 5b", "---", "---", "---", "", "Ab", "m1", "A2"),
+            reader.Record("3", "5b", "Zi", "d3", "B1", "", "Zi", "d3", "A2"),
+        ]
+
+    def test_queries(self):
+        self.archive.add_week(self.monday, [self.rows, self.rows[:1]], "a")
+        self.assertEqual(self.archive.teacher_absences("ab", *self.year), 3)
+        self.assertEqual(self.archive.teacher_absences("zi", *self.year), 0)
+        self.assertEqual(self.archive.top_absent_teachers(*self.year),
+                         [("Ab", 3)])
+        self.assertEqual(self.archive.top_room_changes(*self.year),
+                         [("D108", 2), ("A2", 1)])
+        self.assertEqual(self.archive.grade_substitutions("5B", *self.year), 2)
+        self.assertEqual(self.archive.grade_substitutions(
+            "q34", self.monday, self.monday), 1)
+
+    def test_duplicate_and_new_version(self):
+        self.assertTrue(self.archive.add_week(self.monday, [self.rows], "a"))
+        self.assertFalse(self.archive.add_week(self.monday, [self.rows], "a"))
+        self.assertTrue(self.archive.add_week(self.monday, [self.rows[2:]], "b"))
+        # the new version of the day replaces the old rows
+        self.assertEqual(self.archive.teacher_absences("ab", *self.year), 0)
+        self.assertEqual(self.archive.grade_substitutions("5a", *self.year), 0)
+
+
+class AsyncDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.database = database.AsyncDatabase(":memory:", loop=self.loop)
+
+    def tearDown(self):
+        self.database.close()
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_calls_run_on_thread(self):
+        users = self.database.users
+        self.assertTrue(self.run_coro(users.ensure_user(3)))
+        self.run_coro(users.set_broadcast(3, True))
+        self.assertEqual(self.run_coro(users.get_broadcasters()), [3])
+
+    def test_lone_new_user_written_after_max_delay(self):
+        users = self.database.users
+        users._manager.max_delay = 0.05
+        self.assertTrue(self.run_coro(users.ensure_user(5)))
+        count = lambda: self.database.connection.execute(
+            "SELECT COUNT(*) FROM users").fetchone()[0]
+        self.assertEqual(self.run_coro(self.database.run(count)), 0)
+        self.run_coro(asyncio.sleep(0.1))
+        self.assertEqual(self.run_coro(self.database.run(count)), 1)
+
+    def test_pending_users_written_on_close(self):
+        database_ = database.AsyncDatabase(":memory:", loop=self.loop)
+        self.run_coro(database_.users.ensure_user(5))
+        manager = database_.users._manager
+        database_.close()
+        self.assertEqual(manager.pending, [])
+
+    def test_exceptions_propagate(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.run_coro(self.database.run(self.database.connection.execute,
+                                            "SELECT * FROM nothing"))
+
+    def test_keyword_arguments(self):
+        for chat_id in range(5):
+            self.run_coro(self.database.users.ensure_user(chat_id))
+        self.run_coro(self.database.users.flush())
+        job_id = self.run_coro(
+            self.database.broadcasts.create_job_for_all_users("hallo"))
+        self.assertEqual(len(self.run_coro(
+            self.database.broadcasts.pending_recipients(job_id, limit=2))), 2)
+
+    def test_job_for_all_users(self):
+        for chat_id in range(5):
+            self.run_coro(self.database.users.ensure_user(chat_id))
+        self.run_coro(self.database.users.flush())
+        job_id = self.run_coro(
+            self.database.broadcasts.create_job_for_all_users("hallo"))
+        self.assertEqual(len(self.run_coro(
+            self.database.broadcasts.pending_recipients(job_id))), 5)
+
+
+class FanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.sent = []
+        self.errors = {}
+
+        @asyncio.coroutine
+        def fake_send(chat_id, message):
+            yield from asyncio.sleep(0)
+            error = self.errors.pop(chat_id, None)
+            if error is not None:
+                raise error
+            self.sent.append((chat_id, message))
+
+        self.fanout = broadcast.FanOut(fake_send, concurrency=5, rate=10000,
+                                       per_chat_rate=10000)
+
+    def test_sends_to_all(self):
+        result = self.loop.run_until_complete(
+            self.fanout.run(range(100), "hallo"))
+        self.assertEqual(len(result.sent), 100)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(sorted(i for i, _ in self.sent), list(range(100)))
+
+    def test_retry_on_429(self):
+        self.errors[3] = broadcast.telegram_error({
+            "ok": False, "error_code": 429, "description": "Too Many Requests",
+            "parameters": {"retry_after": 0}})
+        result = self.loop.run_until_complete(self.fanout.run(range(5), "x"))
+        self.assertIn(3, result.sent)
+        self.assertEqual(len(self.sent), 5)
+
+    def test_failure_counted(self):
+        self.errors[3] = telepot.TelegramError("Forbidden", 403)
+        result = self.loop.run_until_complete(self.fanout.run(range(5), "x"))
+        self.assertEqual(result.failed, [3])
+        self.assertEqual(len(result.sent), 4)
+
+    def test_retry_after(self):
+        error = broadcast.telegram_error({
+            "ok": False, "error_code": 429, "description": "Too Many Requests",
+            "parameters": {"retry_after": 7}})
+        self.assertIsInstance(error, telepot.TelegramError)
+        self.assertEqual(broadcast.retry_after(error), 7)
+        self.assertEqual(broadcast.retry_after(
+            telepot.TelegramError("Too Many Requests", 429)), 1)
+        self.assertIsNone(broadcast.retry_after(
+            telepot.TelegramError("Forbidden", 403)))
+
+    def test_rate_limit(self):
+        self.fanout.bucket = ratelimit.TokenBucket(100, 1, loop=self.loop)
+        result = self.loop.run_until_complete(self.fanout.run(range(10), "x"))
+        self.assertGreaterEqual(result.elapsed, 0.08)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_histogram(self):
+        hist = self.registry.histogram("t_seconds", "test", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            hist.observe(value)
+        self.assertEqual(hist.counts, [2, 1, 1])
+        self.assertEqual(hist.quantile(0.5), 0.1)
+        self.assertEqual(hist.quantile(1), float("inf"))
+        text = self.registry.render()
+        self.assertIn('t_seconds_bucket{le="1"} 3', text)
+        self.assertIn('t_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("t_seconds_count 4", text)
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter("t_total", "test")
+        self.assertIs(self.registry.counter("t_total", "test"), counter)
+        counter.inc()
+        value = [5]
+        self.registry.gauge("t_gauge", "test", lambda: value[0])
+        value[0] = 7
+        text = self.registry.render()
+        self.assertIn("t_total 1", text)
+        self.assertIn("t_gauge 7", text)
+
+
+class PlansTest(unittest.TestCase):
+    def test_plan_configs(self):
+        configs = plans.plan_configs({
+            "url": "a", "user": "u", "pass": "p", "token": "t",
+            "plans": "lehrer, ",
+            "lehrer.url": "b", "lehrer.user": "v", "lehrer.pass": "q",
+            "lehrer.rate": "0.5"})
+        self.assertEqual(configs, {
+            "default": {"url": "a", "user": "u", "pass": "p"},
+            "lehrer": {"url": "b", "user": "v", "pass": "q", "rate": "0.5"}})
+
+    def test_plan_names_lowercased(self):
+        configs = plans.plan_configs({
+            "url": "a", "user": "u", "pass": "p", "plans": "Lehrer",
+            "Lehrer.url": "b", "Lehrer.user": "v", "Lehrer.pass": "q"})
+        self.assertEqual(configs["lehrer"],
+                         {"url": "b", "user": "v", "pass": "q"})
+
+    def test_pool_falls_back_to_default(self):
+        pool = plans.ReaderPool({"default": "a", "lehrer": "b"})
+        self.assertEqual(pool.get(None), "a")
+        self.assertEqual(pool.get("lehrer"), "b")
+        self.assertEqual(pool.get("removed"), "a")
+        self.assertEqual(list(pool), ["default", "lehrer"])
+
+    def test_scheduler_spreads_plans(self):
+        loop = asyncio.get_event_loop()
+        runs = []
+
+        @asyncio.coroutine
+        def job(name):
+            runs.append((name, loop.time()))
+            if len(runs) == 4:
+                raise asyncio.CancelledError()
+            if name == "b":
+                raise ValueError("failing jobs don't stop the others")
+
+        scheduler = plans.Scheduler(["a", "b"], lambda: 0.1, loop=loop)
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(scheduler.run(job))
+        self.assertEqual([name for name, _ in runs], ["a", "b", "a", "b"])
+        self.assertGreaterEqual(runs[1][1] - runs[0][1], 0.045)
+
+
+class PollChangesTest(unittest.TestCase):
+    """
+    runs VPlanBot.poll_changes on a stand-in for the bot with a real
+    database and a fake Reader
+    """
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.database = database.AsyncDatabase(":memory:", loop=self.loop)
+        self.rows = [reader.Record("1", "Q34", "Mu", "pw76", "D107", "",
+                                   "Ab", "pw76", "D108")]
+        self.pushed = []
+        self.recipients = []
+        self.weekdays = range(1, 6)
+        test = self
+
+        class FakeReader:
+            @asyncio.coroutine
+            def get_snapshot(self, weeknum):
+                week = [reader.DayInfo(weekday=i, data=list(test.rows))
+                        for i in test.weekdays]
+                digest = str(hash(tuple(test.rows)))
+                return reader.Snapshot(week, digest, None, None, 0)
+
+        class Bot:
+            readers = plans.ReaderPool({plans.DEFAULT: FakeReader(),
+                                        "lehrer": FakeReader()})
+            _polled_digests = {}
+            poll_changes = main.VPlanBot.poll_changes
+            broadcast_groups = main.VPlanBot.broadcast_groups
+
+            @asyncio.coroutine
+            def run_broadcast_job(self, job_id, message):
+                test.pushed.append(message)
+                test.recipients.extend((yield from
+                    test.database.broadcasts.pending_recipients(job_id)))
+
+        self.bot = Bot()
+        self.bot.database = self.database
+        self.bot.substmanager = self.database.substs
+        self.bot.usermanager = self.database.users
+        self.bot.broadcasts = self.database.broadcasts
+        self.loop.run_until_complete(self.database.users.ensure_user(1))
+        self.loop.run_until_complete(self.database.users.set_broadcast(1, True))
+        self.loop.run_until_complete(self.database.users.ensure_user(2))
+        self.loop.run_until_complete(self.database.users.set_broadcast(2, True))
+        self.loop.run_until_complete(self.database.users.set_plan(2, "lehrer"))
+
+    def tearDown(self):
+        self.database.close()
+
+    def poll(self, plan=None):
+        self.loop.run_until_complete(self.bot.poll_changes(plan))
+
+    def test_first_poll_not_pushed(self):
+        self.poll()
+        self.assertEqual(self.pushed, [])
+
+    def test_new_rows_pushed(self):
+        self.poll()
+        self.rows.append(self.rows[0]._replace(period="2", grade="Q3"))
+        self.poll()
+        self.assertEqual(len(self.pushed), 1)
+        self.assertIn("In der 2. Stunde", self.pushed[0])
+        self.assertNotIn("In der 1. Stunde", self.pushed[0])
+
+    def test_pushed_after_prune(self):
+        self.poll()
+        self.loop.run_until_complete(self.database.substs.prune_older_than(
+            datetime.now() + timedelta(days=30)))
+        self.rows = [self.rows[0]._replace(period="3")]
+        self.poll()
+        self.assertEqual(len(self.pushed), 1)
+
+    def test_first_poll_of_each_plan_not_pushed(self):
+        self.poll()
+        self.poll("lehrer")
+        self.assertEqual(self.pushed, [])
+
+    def test_same_row_pushed_to_each_plan(self):
+        self.poll()
+        self.poll("lehrer")
+        self.rows.append(self.rows[0]._replace(period="2", grade="Q3"))
+        self.poll()
+        self.poll("lehrer")
+        self.assertEqual(len(self.pushed), 2)
+        self.assertEqual(self.recipients, [1, 2])
+
+    def test_broadcast_groups_loaded_in_pages(self):
+        self.loop.run_until_complete(self.database.users.ensure_user(3))
+        self.loop.run_until_complete(self.database.users.set_broadcast(3, True))
+        page_size = main.BROADCAST_PAGE_SIZE
+        main.BROADCAST_PAGE_SIZE = 1
+        try:
+            groups = self.loop.run_until_complete(self.bot.broadcast_groups())
+        finally:
+            main.BROADCAST_PAGE_SIZE = page_size
+        self.assertEqual(groups, {(None, frozenset()): [1, 3],
+                                  ("lehrer", frozenset()): [2]})
+
+    def test_dates_follow_anchors(self):
+        self.weekdays = [2, 3, 4, 5]
+        self.poll()
+        self.rows.append(self.rows[0]._replace(period="2", grade="Q3"))
+        self.poll()
+        today = date.today()
+        next_monday = today + timedelta(days=7 - today.weekday())
+        self.assertNotIn(next_monday.strftime("%A, %d. %B"), self.pushed[0])
+        self.assertIn((next_monday + timedelta(days=4)).strftime("%A, %d. %B"),
+                      self.pushed[0])
+
+    def test_format_changes(self):
+        day = date(2016, 12, 5)
+        message = main.format_changes([(day, self.rows[0]),
+                                       (day, self.rows[0]._replace(period="2")),
+                                       (day + timedelta(days=1), self.rows[0])])
+        self.assertTrue(message.startswith("Neue Vertretungen:"))
+        self.assertEqual(message.count(day.strftime("%A, %d. %B")), 1)
+        self.assertEqual(message.count("In der "), 3)
+
+
+class RangeRequestTest(unittest.TestCase):
+    def test_parse_range(self):
+        wednesday = date(2016, 12, 7)
+        self.assertEqual(main.parse_range("0-2", wednesday),
+                         (wednesday, date(2016, 12, 9)))
+        self.assertEqual(main.parse_range("Woche", wednesday),
+                         (date(2016, 12, 5), date(2016, 12, 9)))
+        self.assertEqual(main.parse_range("woche", date(2016, 12, 10)),
+                         (date(2016, 12, 12), date(2016, 12, 16)))
+        for text in ("2", "3-1", "0-30", "a-b", "/abo"):
+            self.assertIsNone(main.parse_range(text, wednesday))
+
+    def test_join_messages(self):
+        self.assertEqual(main.join_messages(["a", "b", "c"]), ["a\n\nb\n\nc"])
+        self.assertEqual(main.join_messages(["aaa", "bbb", "c"], limit=8),
+                         ["aaa\n\nbbb", "c"])
+
+
+class PrefetchIntervalTest(unittest.TestCase):
+    def test_school_morning(self):
+        monday = datetime(2016, 12, 5, 7, 30)
+        self.assertEqual(main.prefetch_interval(monday, 600, 120), 120)
+
+    def test_evening_and_weekend(self):
+        monday_evening = datetime(2016, 12, 5, 19, 0)
+        saturday = datetime(2016, 12, 10, 7, 30)
+        self.assertEqual(main.prefetch_interval(monday_evening, 600, 120), 600)
+        self.assertEqual(main.prefetch_interval(saturday, 600, 120), 600)
+
+    def test_school_year_start(self):
+        self.assertEqual(main.school_year_start(date(2016, 12, 5)),
+                         date(2016, 8, 1))
+        self.assertEqual(main.school_year_start(date(2017, 3, 1)),
+                         date(2016, 8, 1))
+
+
+class BroadcastManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.broadcasts = database.BroadcastManager(self.connection)
+
+    def test_job_lifecycle(self):
+        job_id = self.broadcasts.create_job("hallo", [1, 2, 3])
+        self.assertEqual(self.broadcasts.unfinished_jobs(), [(job_id, "hallo")])
+        self.assertEqual(sorted(self.broadcasts.pending_recipients(job_id)),
+                         [1, 2, 3])
+
+        self.broadcasts.set_state(job_id, [1, 3],
+                                  database.BroadcastManager.SENT)
+        self.assertEqual(self.broadcasts.pending_recipients(job_id), [2])
+
+        self.broadcasts.set_state(job_id, [2], database.BroadcastManager.FAILED)
+        self.broadcasts.finish_job(job_id)
+        self.assertEqual(self.broadcasts.unfinished_jobs(), [])
+        self.assertEqual(self.broadcasts.job_counts(job_id),
+                         {0: 0, 1: 2, 2: 1})
+
+    def test_expire_old_jobs(self):
+        old_job = self.broadcasts.create_job("alt", [1, 2])
+        self.broadcasts.set_state(old_job, [1], database.BroadcastManager.SENT)
+        self.connection.execute("UPDATE broadcast_jobs SET created=? WHERE id=?",
+                                (int(time.time()) - 24*60*60, old_job))
+        new_job = self.broadcasts.create_job("neu", [1, 2])
+
+        expired = self.broadcasts.expire_jobs(time.time() - 12*60*60)
+        self.assertEqual(expired, [(old_job, "alt")])
+        self.assertEqual(self.broadcasts.unfinished_jobs(), [(new_job, "neu")])
+        self.assertEqual(self.broadcasts.job_counts(old_job),
+                         {0: 0, 1: 1, 2: 1})
+
+    def test_pending_limit(self):
+        job_id = self.broadcasts.create_job("hallo", range(10))
+        self.assertEqual(len(self.broadcasts.pending_recipients(job_id, 4)), 4)
+
+
+class SubscriptionStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.users = database.UserManager(self.connection)
+
+    def test_subscribe(self):
+        self.users.create_user(1)
+        self.users.subscribe(1, "grade", "q34")
+        self.users.subscribe(1, "teacher", "mu")
+        self.users.subscribe(1, "teacher", "mu")
+        self.assertEqual(self.users.get_subscriptions(1),
+                         {("grade", "q34"), ("teacher", "mu")})
+        self.users.unsubscribe(1, "teacher", "mu")
+        self.assertEqual(self.users.get_subscriptions(1), {("grade", "q34")})
+
+    def test_broadcast_subscriptions(self):
+        for chat_id in (1, 2, 3):
+            self.users.create_user(chat_id)
+        self.users.set_broadcast(1, True)
+        self.users.set_broadcast(2, True)
+        self.users.subscribe(1, "grade", "q34")
+        self.users.subscribe(3, "grade", "q34")
+        self.assertEqual(self.users.get_broadcast_page(),
+                         [(1, {("grade", "q34")}), (2, frozenset())])
+        self.assertEqual(self.users.get_broadcast_page(1, 5),
+                         [(2, frozenset())])
+        self.assertEqual(self.users.get_broadcast_page(limit=1),
+                         [(1, {("grade", "q34")})])
+
+
 class BroadcastTest(unittest.TestCase):
     def setUp(self):
         self.connection = sqlite3.connect(":memory:")